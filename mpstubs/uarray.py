@@ -0,0 +1,16 @@
+if False:
+    from typing import *  # noqa
+
+
+class array:
+    def __init__(self, typecode, iterable=None):
+        # type: (str, Optional[Iterable]) -> None
+        ...
+
+    def append(self, val):
+        # type: (Any) -> None
+        ...
+
+    def extend(self, iterable):
+        # type: (Iterable) -> None
+        ...
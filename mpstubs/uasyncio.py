@@ -6,9 +6,19 @@ class CancelledError(Exception):
     ...
 
 
+class TimeoutError(Exception):
+    ...
+
+
+class Task:
+    def cancel(self):
+        # type: () -> None
+        ...
+
+
 class PollEventLoop:
     def create_task(self, coro_gen):
-        # type: (Awaitable) -> None
+        # type: (Awaitable) -> Task
         ...
 
     def call_soon(self, func, *args):
@@ -42,3 +52,95 @@ async def sleep(seconds):
 async def sleep_ms(seconds):
     # type: (int) -> None
     ...
+
+
+async def wait_for(aw, timeout):
+    # type: (Awaitable, Union[int, float]) -> Any
+    ...
+
+
+class Event:
+    def is_set(self):
+        # type: () -> bool
+        ...
+
+    def set(self):
+        # type: () -> None
+        ...
+
+    def clear(self):
+        # type: () -> None
+        ...
+
+    async def wait(self):
+        # type: () -> bool
+        ...
+
+
+class Lock:
+    def locked(self):
+        # type: () -> bool
+        ...
+
+    async def acquire(self):
+        # type: () -> bool
+        ...
+
+    def release(self):
+        # type: () -> None
+        ...
+
+    async def __aenter__(self):
+        # type: () -> None
+        ...
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # type: (Any, Any, Any) -> None
+        ...
+
+
+class Stream:
+    s = None  # type: Any
+
+    def get_extra_info(self, v):
+        # type: (str) -> Any
+        ...
+
+    async def read(self, n):
+        # type: (int) -> bytes
+        ...
+
+    async def readline(self):
+        # type: () -> bytes
+        ...
+
+    def write(self, buf):
+        # type: (bytes) -> None
+        ...
+
+    async def drain(self):
+        # type: () -> None
+        ...
+
+    def close(self):
+        # type: () -> None
+        ...
+
+    async def wait_closed(self):
+        # type: () -> None
+        ...
+
+
+class Server:
+    def close(self):
+        # type: () -> None
+        ...
+
+    async def wait_closed(self):
+        # type: () -> None
+        ...
+
+
+async def start_server(cb, host, port, backlog=5):
+    # type: (Callable[[Stream, Stream], Awaitable], str, int, int) -> Server
+    ...
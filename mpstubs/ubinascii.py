@@ -4,3 +4,7 @@ if False:
 
 def hexlify(data: bytes) -> bytes:
     ...
+
+
+def b2a_base64(data: bytes) -> bytes:
+    ...
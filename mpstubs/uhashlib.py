@@ -13,5 +13,20 @@ class SHA256:
         ...
 
 
+class SHA1:
+    def __init__(self, initial_data: bytes):
+        ...
+
+    def update(self, data: bytes):
+        ...
+
+    def digest(self) -> bytes:
+        ...
+
+
 def sha256() -> SHA256:
     ...
+
+
+def sha1(initial_data: bytes = b"") -> SHA1:
+    ...
@@ -2,6 +2,10 @@ if False:
     from typing import *  # noqa
 
 
+class IOBase:
+    ...
+
+
 class StringIO:
     def __init__(self, alloc_size=0):
         # type: (int) -> None
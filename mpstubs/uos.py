@@ -30,3 +30,18 @@ def remove(path):
 def rmdir(path):
     # type: (str) -> None
     ...
+
+
+def ilistdir(path="/"):
+    # type: (str) -> Iterator[Tuple]
+    ...
+
+
+def rename(old_path, new_path):
+    # type: (str, str) -> None
+    ...
+
+
+def statvfs(path):
+    # type: (str) -> Tuple
+    ...
@@ -0,0 +1,25 @@
+if False:
+    from typing import *  # noqa
+
+
+class DecompIO:
+    def __init__(self, stream, wbits=0):
+        # type: (Any, int) -> None
+        ...
+
+    def read(self, size=-1):
+        # type: (int) -> bytes
+        ...
+
+    def readinto(self, buf):
+        # type: (bytearray) -> int
+        ...
+
+    def readline(self):
+        # type: () -> bytes
+        ...
+
+
+def decompress(data, wbits=0, bufsize=0):
+    # type: (bytes, int, int) -> bytes
+    ...
@@ -290,6 +290,15 @@ active. This can be done with a single command, for example:
 kyanitctl BCG -put code.py -reboot
 ```
 
+Instead of `code.py`, a precompiled `code.mpy` may be uploaded (made with `mpy-cross`
+of the same MicroPython version as the firmware). It's imported without compiling on
+the board, which makes starting faster, and leaves more RAM for larger programs. The
+same goes for other modules imported by the code. Keep in mind, that MicroPython
+imports a `.py` file rather than the `.mpy` file of the same name, so remove `code.py`
+when uploading `code.mpy`. Which one was imported is shown as `code_file` by Kyanit
+CTL's `-status` option. If `code.mpy` was compiled for another MicroPython version,
+starting results in an `ERROR ImportError` state naming the file.
+
 For a full list of what Kyanit CTL can do, refer to the command-line help with
 `kyanitctl -h`.
 
@@ -300,7 +309,7 @@ There are 5 different run states: `CODE.PY MISSING`, `CODE.PY IMPORTED`, `CODE.P
 
 * **`CODE.PY MISSING`**
 
-There's no `code.py` file to import and run.
+There's no `code.py` (or `code.mpy`) file to import and run.
 
 * **`CODE.PY IMPORTED`**
 
@@ -531,6 +540,7 @@ import ujson
 import machine
 import network
 import neopixel
+import uzlib
 import uhashlib
 import ubinascii
 
@@ -644,12 +654,21 @@ class Netvar:
     intended to be accessed continuously, because the network overhead would
     substantially slow down the operation of the Kyanit board.
 
+    Changes of the outbound variable (and of the run state) can also be followed without
+    polling, as server-sent events from `GET /netvar/events` on port 3300. For
+    interactive control, a WebSocket at `/netvar/ws` on port 3300 sets the inbound
+    variable for every JSON text message received, and sends the outbound variable as
+    a JSON text message whenever it's set. At most 2 of these streams may be open at
+    the same time, further ones get a `503 Service Unavailable` response.
+
     Instead use it for user commands, which depending on the project can be things like
     switching, reading sensor data, changing the LED colors, etc.
     """
 
     _in = None
     _out = None
+    _version = 0  # incremented whenever the outbound variable is set or cleared
+    _changed = runner.Event()  # set then, and whenever the run state changes
 
     @staticmethod
     def inbound(obj=None, clear=False):
@@ -678,12 +697,16 @@ class Netvar:
 
         if clear:
             Netvar._out = None
+            Netvar._version += 1
+            Netvar._changed.set()
             return
 
         if obj is None:
             return Netvar._out
 
         Netvar._out = obj
+        Netvar._version += 1
+        Netvar._changed.set()
 
 
 def get_color_id():
@@ -796,7 +819,59 @@ def controls(
 def run():
     global _color_id
 
-    PROTECTED_FILES = ["/main.py", "/boot.py", "/_boot.py"]
+    MANIFEST_FILE = "/.manifest.json"
+    PROTECTED_FILES = ["/main.py", "/boot.py", "/_boot.py", MANIFEST_FILE]
+    RESPONSE_OK = httpsrv.prepare(200, '"OK"', httpsrv.CT_JSON)
+    RESPONSE_STREAMS_BUSY = httpsrv.prepare(
+        503, '"Too Many Streams"', httpsrv.CT_JSON, {"Retry-After": "5"}
+    )
+    # accepted content codings of uploads, and uzlib wbits to decompress them with
+    UPLOAD_ENCODINGS = {"identity": 0, "gzip": 31, "deflate": 15}
+    RUN_STATES = (
+        "ERROR",
+        "STOPPED",
+        "CODE.PY MISSING",
+        "CODE.PY IMPORTED",
+        "CODE.PY MAIN",
+    )
+    EVENTS_KEEPALIVE_INTERVAL = 15  # seconds
+    WS_PING_INTERVAL = 15  # seconds
+    ARCHIVE_HEAD_MAX = 80  # bytes
+    TRANSFER_BUF_SIZE = 1024  # a multiple of the flash block size
+
+    class NetvarEvents:
+        # Asynchronous iterator yielding server-sent events when Netvar.outbound is set
+        # or the run state changes. Only the latest values are sent, if they change
+        # faster than they can be sent.
+
+        def __init__(self):
+            self._version = -1  # never the version of the outbound value, so it's sent
+            self._state = None
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            while True:
+                if Netvar._version != self._version:
+                    self._version = Netvar._version
+                    return "event: netvar\ndata: {}\n\n".format(
+                        ujson.dumps(Netvar._out)
+                    )
+
+                state = run_state()
+                if state != self._state:
+                    self._state = state
+                    return "event: state\ndata: {}\n\n".format(ujson.dumps(state))
+
+                Netvar._changed.clear()
+                try:
+                    await runner.wait_for(
+                        Netvar._changed.wait(), EVENTS_KEEPALIVE_INTERVAL
+                    )
+                except runner.TimeoutError:
+                    # detects closed connections, and keeps proxies from timing out
+                    return ": keep-alive\n\n"
 
     class FileServerError(Exception):
         pass
@@ -834,30 +909,187 @@ def run():
                     )  # noqa
                 )
 
-    def action_file_list(*args):
+    def iter_entries():
+        # (name, type, size) of the entries in the root dir, in a single walk
+        for entry in uos.ilistdir("/"):
+            name, kind = entry[0], entry[1]
+            if "\x00" in name or "/" + name in PROTECTED_FILES:
+                continue  # ignore garbage files
+            if kind != 32768:
+                size = 0
+            elif len(entry) > 3:
+                size = entry[3]
+            else:
+                size = uos.stat(name)[6]  # no size from older filesystem drivers
+            yield name, kind, size
+
+    def iter_files():
+        # (name, size) of the regular files in the root dir
+        for name, kind, size in iter_entries():
+            if kind == 32768:
+                yield name, size
+
+    def file_list_json(details):
+        # generator of the JSON list of files (names only, unless details is set, in
+        # which case directories are included too), so it's streamed as it's walked
+        yield "["
+        sep = ""
+        if details:
+            for name, kind, size in iter_entries():
+                yield sep
+                yield ujson.dumps(
+                    {
+                        "name": name,
+                        "type": "file" if kind == 32768 else "dir",
+                        "size": size,
+                    }
+                )
+                sep = ", "
+        else:
+            for name, size in iter_files():
+                yield sep
+                yield ujson.dumps(name)
+                sep = ", "
+        yield "]"
+
+    def action_file_list(method, loc, params, headers, conn, addr):
+        if "archive" in params:
+            return action_archive(method, loc, params, headers, conn, addr)
+        if "manifest" in params:
+            return action_manifest(method, loc, params, headers, conn, addr)
         return httpsrv.response(
-            200,
-            ujson.dumps(
-                [
-                    path
-                    for path in uos.listdir("/")
-                    if "\x00" not in path  # ignore garbage files
-                    and uos.stat(path)[0] == 32768  # noqa
-                    and path not in PROTECTED_FILES  # noqa
-                ]
-            ),
-            httpsrv.CT_JSON,
+            200, file_list_json("details" in params), httpsrv.CT_JSON
         )
 
-    def action_files(method, loc, params, headers, conn, addr):
-        if "/" in loc[7:]:  # only files in root dir are allowed
-            raise FileServerError("not on root")
+    def hash_file(file_name):
+        hasher = uhashlib.sha256()
+        buf = bytearray(TRANSFER_BUF_SIZE)
+        buf_mv = memoryview(buf)
+        with open(file_name, "rb") as file:
+            while True:
+                count = file.readinto(buf)
+                if not count:
+                    break
+                hasher.update(buf_mv[:count])
+        return str(ubinascii.hexlify(hasher.digest()), "utf-8")
+
+    class Manifest:
+        # Sizes, modification times and sha256 digests of files, kept in a small index
+        # on flash. Entries are dropped when files are changed through the API, and are
+        # computed again when the stat does not match (the file was changed by user
+        # code). The index is only written when files are changed through the API.
+
+        def __init__(self):
+            self._entries = None  # file name: [size, mtime, digest], loaded when needed
+            self._changed = False
+
+        def _load(self):
+            if self._entries is None:
+                try:
+                    with open(MANIFEST_FILE) as file:
+                        self._entries = ujson.load(file)
+                except (OSError, ValueError):
+                    self._entries = {}
+            return self._entries
+
+        def digest(self, file_name, stat):
+            entry = self._load().get(file_name)
+            if entry is None or entry[:2] != [stat[6], stat[8]]:
+                entry = [stat[6], stat[8], hash_file(file_name)]
+                self._entries[file_name] = entry
+                self._changed = True
+            return entry[2]
+
+        def set(self, file_name, digest):
+            stat = uos.stat(file_name)
+            self._load()[file_name] = [stat[6], stat[8], digest]
+            self._changed = True
+
+        def drop(self, file_name):
+            if file_name in self._load():
+                del self._entries[file_name]
+                self._changed = True
+
+        def save(self):
+            if self._changed:
+                with open(MANIFEST_FILE, "w") as file:
+                    ujson.dump(self._entries, file)
+                self._changed = False
+
+    manifest = Manifest()
+
+    def action_manifest(method, loc, params, headers, conn, addr):
+        files = []
+        for path, size in iter_files():
+            digest = manifest.digest("/" + path, uos.stat("/" + path))
+            files.append({"name": path, "size": size, "sha256": digest})
+        return httpsrv.response(200, ujson.dumps(files), httpsrv.CT_JSON)
+
+    def file_stat(file_name):
+        # stat of a regular file, None if it does not exist
+        try:
+            stat = uos.stat(file_name)
+        except OSError:
+            return None
+        return stat if stat[0] == 32768 else None
+
+    class UploadFile:
+        # A temporary file to receive file_name into, hashing what's written. It
+        # replaces the file on commit, and it's removed on discard.
+
+        def __init__(self, file_name):
+            self.file_name = file_name
+            self.temp_name = file_name + ".part"
+            self._file = open(self.temp_name, "wb")
+            self._hasher = uhashlib.sha256()
+            self._digest = None
+
+        def write(self, data):
+            self._hasher.update(data)
+            return self._file.write(data)
+
+        def hexdigest(self):
+            # the digest of a hash object can only be taken once, so it's kept
+            if self._digest is None:
+                self._digest = str(ubinascii.hexlify(self._hasher.digest()), "utf-8")
+            return self._digest
+
+        def commit(self):
+            self._file.close()
+            replace_file(self.temp_name, self.file_name)
+            file_changed(self.file_name)
+            # the digest is known, so it's not computed again
+            manifest.set(self.file_name, self.hexdigest())
+            manifest.save()
+
+        def discard(self):
+            self._file.close()
+            if file_stat(self.temp_name) is not None:
+                uos.remove(self.temp_name)
+
+    def replace_file(source, target):
+        try:
+            uos.rename(source, target)
+        except OSError:
+            # FAT does not rename over an existing file
+            uos.remove(target)
+            uos.rename(source, target)
 
-        file_name = loc[6:]
+    def file_changed(file_name):
+        # a precompressed sidecar is kept, it's not served while older than the file
+        manifest.drop(file_name)
+        manifest.drop(file_name + ".gz")
 
+    def check_file_name(file_name):
+        if "/" in file_name[1:]:  # only files in root dir are allowed
+            raise FileServerError("not on root")
         if file_name in PROTECTED_FILES:
             raise FileServerError("restricted")
 
+    def action_files(method, loc, params, headers, conn, addr):
+        file_name = loc[6:]
+        check_file_name(file_name)
+
         try:
             stat = uos.stat(file_name)
         except OSError:
@@ -869,26 +1101,183 @@ def run():
 
         if method == "DELETE":
             uos.remove(file_name)
-            return httpsrv.response(200, '"OK"', httpsrv.CT_JSON)
+            file_changed(file_name)
+            manifest.save()
+            return RESPONSE_OK
 
         if method == "GET":
-            with open(file_name, "rb") as file:
-                # read from file, send to conn
-                httpsrv.send_response(
-                    conn, **(httpsrv.response(200, content_type=httpsrv.CT_PLAIN))
+            size = stat[6]
+            resp_headers = {"Accept-Ranges": "bytes"}
+            gz_stat = file_stat(file_name + ".gz")
+            if gz_stat is not None and gz_stat[8] >= stat[8]:
+                resp_headers["Vary"] = "Accept-Encoding"
+                if httpsrv.accepts_encoding(headers, "gzip"):
+                    # send the precompressed sidecar as it is
+                    file_name += ".gz"
+                    stat = gz_stat
+                    size = gz_stat[6]
+                    resp_headers["Content-Encoding"] = "gzip"
+
+            etag = httpsrv.file_etag(stat)
+            if etag is not None:
+                resp_headers["ETag"] = etag
+                resp = httpsrv.not_modified(headers, etag)
+                if resp is not None:
+                    return resp
+
+            file_range = httpsrv.byte_range(headers, size, etag)
+            if file_range is None:
+                resp_headers["Content-Length"] = size
+                # the file is streamed by the server, and closed when sent
+                return httpsrv.response(
+                    200, open(file_name, "rb"), httpsrv.CT_PLAIN, resp_headers
                 )
-                httpsrv.readall_from(file, into=conn)
-            return None  # response already assembled above
+
+            start, stop = file_range
+            if start == stop:
+                return httpsrv.response(
+                    416,
+                    '"Range Not Satisfiable"',
+                    httpsrv.CT_JSON,
+                    {"Content-Range": "bytes */{}".format(size)},
+                )
+
+            resp_headers["Content-Length"] = stop - start
+            resp_headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, stop - 1, size
+            )
+            # only the range is streamed, starting from where the file is seeked to
+            file = open(file_name, "rb")
+            file.seek(start)
+            return httpsrv.response(206, file, httpsrv.CT_PLAIN, resp_headers)
 
         elif method == "PUT":
             if "rename" in params:
-                uos.rename(file_name, params["rename"])
-                return httpsrv.response(200, '"OK"', httpsrv.CT_JSON)
+                new_name = params["rename"]
+                if not isinstance(new_name, str) or not new_name.strip("/"):
+                    raise FileServerError("name invalid")
+                # relative to root like uos.rename, but as the manifest keys it
+                new_name = "/" + new_name.lstrip("/")
+                check_file_name(new_name)
+                uos.rename(file_name, new_name)
+                file_changed(file_name)
+                file_changed(new_name)
+                manifest.save()
+                return RESPONSE_OK
+
+            source = conn
+            encoding = headers.get("content-encoding", "identity").lower()
+            if encoding in UPLOAD_ENCODINGS:
+                if UPLOAD_ENCODINGS[encoding]:
+                    # decompressed while receiving
+                    source = uzlib.DecompIO(conn, UPLOAD_ENCODINGS[encoding])
+            else:
+                return httpsrv.response(
+                    415, '"Unsupported Content Encoding"', httpsrv.CT_JSON
+                )
 
-            with open(file_name, "wb") as file:
+            # The file is replaced only when the whole body is received, and it matches
+            # the digest if the client sent one.
+            upload = UploadFile(file_name)
+            try:
                 # write to file, receive from conn
-                httpsrv.readall_from(conn, into=file)
-            return httpsrv.response(200, '"OK"', httpsrv.CT_JSON)
+                httpsrv.transfer(source, upload, buf=bytearray(TRANSFER_BUF_SIZE))
+                if not conn.received_all():
+                    raise FileServerError("upload incomplete")
+                digest = upload.hexdigest()
+                expected = headers.get("x-content-sha256")
+                if expected is not None and expected.lower() != digest:
+                    upload.discard()
+                    return httpsrv.response(400, '"Digest Mismatch"', httpsrv.CT_JSON)
+                upload.commit()
+            except Exception:
+                upload.discard()
+                raise
+            return httpsrv.response(
+                200, '"OK"', httpsrv.CT_JSON, {"X-Content-SHA256": digest}
+            )
+
+    # Archives hold files as records of a "<size> <name>\n" head (size in decimal,
+    # name without the leading slash) followed by the size bytes of the file.
+
+    async def read_record_head(conn, buf):
+        # return (size, file name) of the next record, None at the end of the archive
+        # (buf holds the head, so a longer one is invalid)
+        count = await conn.areadline(buf)
+        if not count:
+            return None
+        if buf[count - 1] != 10:
+            if count < len(buf):
+                raise FileServerError("archive incomplete")
+            raise FileServerError("archive record invalid")
+        try:
+            size, name = str(buf[:count - 1], "utf-8").split(" ", 1)
+            size = int(size)
+        except ValueError:
+            raise FileServerError("archive record invalid")
+        if size < 0 or not name:
+            raise FileServerError("archive record invalid")
+        return size, "/" + name
+
+    async def unpack_archive(conn):
+        # write every file of the archive, and return their digests by name
+        digests = {}
+        buf = bytearray(TRANSFER_BUF_SIZE)
+        head_buf = bytearray(ARCHIVE_HEAD_MAX + 1)  # with the line break
+        while True:
+            record = await read_record_head(conn, head_buf)
+            if record is None:
+                return digests
+            size, file_name = record
+            check_file_name(file_name)
+            upload = UploadFile(file_name)
+            try:
+                if await httpsrv.atransfer(conn, upload, size, buf) != size:
+                    raise FileServerError("archive incomplete")
+                upload.commit()
+            except Exception:
+                upload.discard()
+                raise
+            digests[file_name[1:]] = upload.hexdigest()
+
+    def pack_archive(names):
+        # generator of the archive of the files, read through a fixed buffer
+        buf = bytearray(TRANSFER_BUF_SIZE)
+        buf_mv = memoryview(buf)
+        for name in names:
+            stat = file_stat("/" + name)
+            if stat is None:
+                continue  # removed since
+            yield "{} {}\n".format(stat[6], name)
+            left = stat[6]
+            with open("/" + name, "rb") as file:
+                while left > 0:
+                    count = file.readinto(buf_mv[:min(left, len(buf))])
+                    if not count:
+                        raise FileServerError("file changed")
+                    yield buf_mv[:count]
+                    left -= count
+
+    async def action_archive(method, loc, params, headers, conn, addr):
+        # a coroutine, so other requests and tasks run while an archive is received
+        if method == "PUT":
+            # files already unpacked are kept, if unpacking fails
+            return httpsrv.response(
+                200, ujson.dumps(await unpack_archive(conn)), httpsrv.CT_JSON
+            )
+
+        names = params["archive"]
+        if isinstance(names, str):
+            names = [names]
+        elif isinstance(names, list):
+            names = [name for name in names if name is not None]  # ?archive&archive=x
+        if not names:
+            names = [name for name, size in iter_files()]
+        for name in names:
+            check_file_name("/" + name)
+            if file_stat("/" + name) is None:
+                return httpsrv.response(404, '"File Not Found"', httpsrv.CT_JSON)
+        return httpsrv.response(200, pack_archive(names), "application/octet-stream")
 
     async def reboot():
         await runner.sleep(.1)
@@ -898,7 +1287,13 @@ def run():
     def action_reboot(method, loc, params, headers, conn, addr):
         runner.stop(exc=RebootError)
         runner.get_event_loop().create_task(reboot())
-        return httpsrv.response(200, '"OK"', httpsrv.CT_JSON)
+        return RESPONSE_OK
+
+    def run_state():
+        state = runner.get_state()
+        if state == runner.ERROR:
+            return "ERROR {}".format(runner.get_error()[0])
+        return RUN_STATES[state]
 
     def action_state(method, loc, params, headers, conn, addr):
         return httpsrv.response(
@@ -915,15 +1310,8 @@ def run():
                     "color_id": _color_id,
                     "free_memory": gc.mem_free(),
                     "free_flash": uos.statvfs("/")[0] * uos.statvfs("/")[3],
-                    "run_state": [
-                        "ERROR {}".format(runner.get_error()[0])
-                        if runner.get_error() is not None
-                        else "",
-                        "STOPPED",
-                        "CODE.PY MISSING",
-                        "CODE.PY IMPORTED",
-                        "CODE.PY MAIN",
-                    ][runner.get_state()],
+                    "run_state": run_state(),
+                    "code_file": runner.get_code_file(),
                     "error_traceback": [
                         line.strip()
                         for line in runner.get_error()[1].split("\n")
@@ -936,23 +1324,76 @@ def run():
             httpsrv.CT_JSON,
         )
 
+    def action_metrics(method, loc, params, headers, conn, addr):
+        return httpsrv.response(
+            200, ujson.dumps(http_server.get_metrics()), httpsrv.CT_JSON
+        )
+
     def action_runner_start(method, loc, params, headers, conn, addr):
         runner.start()
-        return httpsrv.response(200, '"OK"', httpsrv.CT_JSON)
+        return RESPONSE_OK
 
     def action_runner_stop(method, loc, params, headers, conn, addr):
         runner.stop(force=True if "force" in loc else False, exc=StoppedError)
-        return httpsrv.response(200, '"OK"', httpsrv.CT_JSON)
+        return RESPONSE_OK
 
     def action_netvar(method, loc, params, headers, conn, addr):
         if method == "POST":
             Netvar.inbound(ujson.loads(httpsrv.readall_from(conn).getvalue().decode()))
-            return httpsrv.response(200, '"OK"', httpsrv.CT_JSON)
+            return RESPONSE_OK
         if method == "GET":
             return httpsrv.response(
                 200, ujson.dumps(Netvar.outbound()), httpsrv.CT_JSON
             )
 
+    def action_netvar_events(method, loc, params, headers, conn, addr):
+        # the connection is held open until the client closes it
+        if not http_server.open_stream(conn):
+            return RESPONSE_STREAMS_BUSY
+        return httpsrv.response(
+            200, NetvarEvents(), "text/event-stream", {"Cache-Control": "no-cache"}
+        )
+
+    async def push_netvar(ws):
+        # send the outbound variable when it's set, and a ping when idle
+        version = -1  # never the version of the outbound value, so it's sent first
+        try:
+            while not ws.closed:
+                if Netvar._version != version:
+                    version = Netvar._version
+                    await ws.send(ujson.dumps(Netvar._out))
+                    continue
+                Netvar._changed.clear()
+                try:
+                    await runner.wait_for(Netvar._changed.wait(), WS_PING_INTERVAL)
+                except runner.TimeoutError:
+                    await ws.ping()
+        except OSError:
+            await ws.close(1011)
+
+    async def action_netvar_ws(method, loc, params, headers, conn, addr):
+        if not http_server.open_stream(conn):
+            return RESPONSE_STREAMS_BUSY
+        ws = await httpsrv.accept_websocket(conn, headers)
+        if ws is None:
+            return httpsrv.response(
+                400, '"WebSocket Upgrade Required"', httpsrv.CT_JSON
+            )
+
+        # outbound values are pushed by a separate task, while this one receives
+        pusher = runner.get_event_loop().create_task(push_netvar(ws))
+        try:
+            while True:
+                message = await ws.receive()
+                if message is None:
+                    break
+                try:
+                    Netvar.inbound(ujson.loads(message))
+                except ValueError:
+                    await ws.close(1007)  # not JSON
+        finally:
+            pusher.cancel()
+
     # Start in fallback AP mode if the button is pressed
     fallback_ap_mode = False
     button = machine.Signal(machine.Pin(BUTTON_PIN, machine.Pin.IN), invert=True)
@@ -994,7 +1435,12 @@ def run():
     )
 
     # Set up HTTP server
-    http_server = httpsrv.HTTPServer(port=3300)
+    httpsrv.add_status(415, "Unsupported Media Type")
+    http_server = httpsrv.HTTPServer(port=3300, backlog=2)
+    http_server.set_keep_alive(5, max_requests=100, max_connections=2)
+    # event streams are limited separately, so they leave room for other requests
+    http_server.set_load_limits(max_connections=4, min_free_memory=4096, max_streams=2)
+    runner.notify_state(Netvar._changed)
 
     # File actions
     http_server.register("GET", "^/files$", action_file_list)
@@ -1002,9 +1448,11 @@ def run():
     http_server.register("GET", "^/files/.*", action_files)
     http_server.register("PUT", "^/files/.*", action_files)
     http_server.register("DELETE", "^/files/.*", action_files)
+    http_server.register("PUT", "^/files$", action_archive)
 
     # System actions
     http_server.register("GET", "^/sys/state$", action_state)
+    http_server.register("GET", "^/sys/metrics$", action_metrics)
     http_server.register("POST", "^/sys/reboot$", action_reboot)
     http_server.register("POST", "^/sys/reboot/soft$", action_reboot)
 
@@ -1016,6 +1464,8 @@ def run():
     # Netvar actions
     http_server.register("GET", "^/netvar$", action_netvar)
     http_server.register("POST", "^/netvar$", action_netvar)
+    http_server.register("GET", "^/netvar/events$", action_netvar_events)
+    http_server.register("GET", "^/netvar/ws$", action_netvar_ws)
 
     # RUN
     loop = runner.get_event_loop()
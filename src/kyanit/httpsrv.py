@@ -15,25 +15,58 @@
 
 # This is a minimal HTTP server module.
 
+# NOTES ON CONNECTIONS
+# Connections are accepted by a uasyncio stream server, and every connection is handled
+# in its own task, so a slow client does not hold up other clients or other tasks.
+# The number of connections processed at once is limited (see
+# HTTPServer.set_load_limits), connections over the limit get a 503 response.
+# Long-lived streams (server-sent events, WebSockets) are limited separately, if the
+# callback opens them with HTTPServer.open_stream.
+# Reading the request and sending a returned response yield to the event loop.
+# Callbacks may be regular functions or coroutines (defined with async def). Regular
+# functions get the connection socket in blocking mode (with the timeout set by
+# set_timeout), so they should return quickly. Coroutines are awaited, so they may take
+# longer, if they await while waiting (ex. use conn.aread and conn.awrite for socket
+# I/O, and runner.sleep for delays).
+# Counters and latency histograms are kept per route (see HTTPServer.get_metrics).
+
 # NOTES ON HEADERS
-# No headers are taken into account, rather they are passed to callbacks and it's the
-# user's responsibility to do something with them.
-# Connection: close is always added to response headers.
+# Apart from Content-Length, Transfer-Encoding, Connection and Expect, no headers are
+# taken into account, rather they are passed to callbacks and it's the user's
+# responsibility to do something with them. They are passed as a Headers object, which
+# only parses them when needed. The number and total size of request headers is
+# limited (see HTTPServer.set_header_limits). Requests with a Content-Length that is not
+# a decimal number get a 400 response.
+# Connection: close is added to response headers, unless keep-alive is enabled with
+# HTTPServer.set_keep_alive, in which case HTTP/1.1 connections (and HTTP/1.0 ones
+# asking for it) are kept open for further requests. Pipelined requests are processed
+# in order.
+# Content-Length is added to response headers, unless the callback already added it.
 # Content-type: text/plain is the default content type.
+# Conditional GET requests can be answered with not_modified(headers, etag), which
+# returns a 304 response if If-None-Match matches the entity tag (see file_etag).
 
 # NOTES ON URLS
-# Only the unreserved characters are allowed in the URL, plus the forward slash and the
-# percent character for percent-encoding, but only the reserved characters and the space
-# are un-encoded after parsing by default.
-# Supported percent-encoded symbols can be extended by means of add_symbol(perc_enc,
-# symbol). More info on URLs and percent-encoding here:
+# Only the unreserved characters should be used in the URL, plus the forward slash and
+# the percent character for percent-encoding. Every percent-encoded byte is un-encoded
+# after parsing, and the result is decoded as UTF-8. If it's not valid UTF-8, the
+# percent-encodings are left as they are.
+# The symbol a percent-encoding is un-encoded to can be overridden by means of
+# add_symbol(perc_enc, symbol). More info on URLs and percent-encoding here:
 # https://en.wikipedia.org/wiki/Percent-encoding
 # If the request URL is not all-ASCII, you will get an instant closure of connection
 # with no response. (Behavior observed on ESP8266.)
+# Query parameters are passed to callbacks as a dict. Parameters without a value are
+# set to None, and if a parameter is repeated in the query, its value will be a list of
+# all the values in the order they were given.
 
 # NOTES ON URL RESOLVING
 # Callbacks are assigned to regex rules. Only one such regex rule should match for any
 # given URL, otherwise unexpected behavior may occur.
+# Rules are compiled when registered. Rules matching a single literal path (ex.
+# "^/sys/state$") are looked up directly, and rules starting with a literal path (ex.
+# "^/files/.*") are only tried when the URL starts with that path, so adding many rules
+# does not slow down URL resolving much.
 
 # NOTES ON CONTENT TYPES
 # text/plain, text/html and application/json are available as CT_PLAIN, CT_HTML and
@@ -41,7 +74,8 @@
 # content type.
 
 # NOTES ON RESPONSE STATUSES
-# Only statuses 200, 404 and 500 are supported by default.
+# Only statuses 200, 206, 304, 400, 404, 414, 416, 431, 500 and 503 are supported by
+# default.
 # This can be extended, by means of add_status(num, status_str).
 # Ex.: add_status(204, 'No Content')
 # No checks are done on the added statuses, it's the user's responsibility that they
@@ -60,6 +94,13 @@
 # which means that a URL needs to be registered for every method that's supported on
 # that URL.
 
+# NOTES ON WEBSOCKETS
+# A coroutine callback may accept a WebSocket upgrade request with accept_websocket,
+# then exchange messages on the returned WebSocket until it's closed, and return None.
+# The WebSocket runs in the task of the connection. Messages are received into a fixed
+# buffer, and fragmented messages are reassembled in it. Extensions and subprotocols
+# are not supported.
+
 """
 # `kyanit.httpsrv` module
 
@@ -85,58 +126,102 @@ def cleanup(exception):
     pass
 ```
 
+Callbacks may also take a single `Request` object, if registered with `request=True`,
+and return a `Response`:
+
+```python
+def render_page(request):
+    return httpsrv.Response(200, 'Hello {}!'.format(request.params.get('name')))
+
+http_server.register('GET', '^/page$', render_page, request=True)
+```
+
 See the `HTTPServer` class and module function documentations for details on usage.
 """
 
+import gc
 import sys
 import socket
 
 import uio
 import ure
+import utime
+import uarray
 import ujson
 import uerrno
 import uasyncio
+import uhashlib
+import ubinascii
 
 _http_ver = "HTTP/1.1"
 
 _statuses = {
     200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
     404: "Not Found",
+    414: "URI Too Long",
+    416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large",
     500: "Internal Server Error",
+    503: "Service Unavailable",
 }
 
-_percent_encodings = {
-    "%20": " ",
-    "%21": "!",
-    "%23": "#",
-    "%24": "$",
-    "%25": "%",
-    "%26": "&",
-    "%27": "'",
-    "%28": "(",
-    "%29": ")",
-    "%2A": "*",
-    "%2B": "+",
-    "%2C": ",",
-    "%2F": "/",
-    "%3A": ":",
-    "%3B": ";",
-    "%3D": "=",
-    "%3F": "?",
-    "%40": "@",
-    "%5B": "[",
-    "%5D": "]",
-}
+# percent-encodings with a custom symbol, added by add_symbol
+_percent_encodings = {}
+
+# sent as is when the server is overloaded
+_unavailable_response = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+)
+
+# encoded status lines by status number
+_status_lines = {}
+
+# status line and headers of a response are assembled in this buffer
+_head_buf = bytearray(256)
+_head_mv = memoryview(_head_buf)
+
+# bytes-like bodies are written to the stream in slices of this size
+_write_slice = 512
+
+# request bodies are read in pieces of this size
+_read_size = 64
+
+# streamed bodies (files, generators) are sent through a buffer of this size
+_stream_buf_size = 256
+
+# default buffer size of transfer, a multiple of flash block sizes (512 bytes on FAT)
+_transfer_size = 1024
+
+_regex_special = "\\.^$*+?{}[]|()"
 
 CT_PLAIN = "text/plain"
 CT_HTML = "text/html"
 CT_JSON = "application/json"
 
+_ws_guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# upper bounds of the latency histogram buckets in microseconds, the last bucket is for
+# anything above
+_metric_bounds = (1000, 5000, 20000, 100000, 500000)
+_metric_phases = ("parse", "handler", "send")
+# counters per route: requests, errors, bytes in, bytes out, then the histograms
+_metric_fields = 4 + len(_metric_phases) * (len(_metric_bounds) + 1)
+
 
 def add_status(num, status_str):
     """
-    By default only `200 OK`, `404 Not Found` and `500 Internal Server Error` HTTP
-    status codes are available in `kyanit.httpsrv`.
+    By default only `200 OK`, `206 Partial Content`, `304 Not Modified`,
+    `400 Bad Request`, `404 Not Found`, `414 URI Too Long`,
+    `416 Range Not Satisfiable`, `431 Request Header Fields Too Large`,
+    `500 Internal Server Error` and `503 Service Unavailable` HTTP status codes are
+    available in `kyanit.httpsrv`.
 
     You may extend this by adding statuses with this function, where `num` is the status
     code number (int) and `status_str` is the string.
@@ -155,34 +240,89 @@ def add_status(num, status_str):
 
 def add_symbol(perc_enc, symbol):
     """
-    This function extends percent-encoded symbols in a URL. By default only the reserved
-    characters and space are un-encoded.
-    (See https://en.wikipedia.org/wiki/Percent-encoding )
+    This function overrides the symbol a percent-encoding is un-encoded to in a URL. By
+    default every percent-encoded byte is un-encoded, and the resulting bytes are
+    decoded as UTF-8. (See https://en.wikipedia.org/wiki/Percent-encoding )
 
-    Extend the supported characters with this function where `perc_enc` is the percent-
-    encoded representation and `symbol` is the encoded character. You are responsible
-    for making the encoded symbols compliant to HTTP specifications.
+    `perc_enc` is the percent-encoded representation (ex. `'%7E'`), and `symbol` is the
+    string it should be replaced with. You are responsible for making the encoded
+    symbols compliant to HTTP specifications.
     """
 
     global _percent_encodings
 
+    perc_enc = perc_enc.upper()
     if perc_enc not in _percent_encodings:
-        _percent_encodings[perc_enc] = symbol
+        _percent_encodings[perc_enc] = symbol.encode()
 
 
 def unencode(string):
     """
     This function accepts a string with percent-encoded characters and returns the
     unencoded string.
+
+    The string is returned as is, if it has no percent-encoded characters.
     """
 
-    if not string:
+    if not string or "%" not in string:
         return string
 
-    new_str = string
-    for perc_enc in _percent_encodings:
-        new_str = new_str.replace(perc_enc, _percent_encodings[perc_enc])
-    return new_str
+    data = string.encode()
+    return _unquote(data, 0, len(data))
+
+
+def _hex_value(char):
+    if 48 <= char <= 57:  # 0-9
+        return char - 48
+    char |= 32  # lower case
+    if 97 <= char <= 102:  # a-f
+        return char - 87
+    return -1
+
+
+def _unquote(data, start, end):
+    # Un-encode data[start:end] (bytes) into a string in a single pass. Invalid or
+    # incomplete percent-encodings are left as they are, and so is everything if the
+    # result is not valid UTF-8.
+    pos = data.find(b"%", start, end)
+    if pos < 0:
+        return data[start:end].decode()
+
+    data_mv = memoryview(data)
+    unquoted = bytearray()
+    first = start
+    while pos >= 0:
+        unquoted.extend(data_mv[start:pos])
+
+        if pos + 2 < end:
+            high = _hex_value(data[pos + 1])
+            low = _hex_value(data[pos + 2])
+        else:
+            high = low = -1
+
+        if high < 0 or low < 0:
+            unquoted.append(37)  # "%"
+            start = pos + 1
+        else:
+            if _percent_encodings:
+                symbol = _percent_encodings.get(data[pos:pos + 3].decode().upper())
+            else:
+                symbol = None
+
+            if symbol is None:
+                unquoted.append(high * 16 + low)
+            else:
+                unquoted.extend(symbol)
+            start = pos + 3
+
+        pos = data.find(b"%", start, end)
+
+    unquoted.extend(data_mv[start:end])
+    try:
+        return str(unquoted, "utf-8")
+    except UnicodeError:
+        # not text, left percent-encoded
+        return data[first:end].decode()
 
 
 def response(status, body="", content_type=CT_PLAIN, headers={}):
@@ -191,6 +331,17 @@ def response(status, body="", content_type=CT_PLAIN, headers={}):
 
     This function should be used from within a callback after assembling the response
     status, body and headers.
+
+    `body` may be a string or a bytes-like object. It may also be a file object opened
+    in binary mode, a generator (or any iterator) yielding strings or bytes-like
+    objects, or an asynchronous iterator doing the same (an object with `__aiter__` and
+    `__anext__`, since MicroPython has no asynchronous generators). These are streamed
+    with chunked transfer-encoding, through a small fixed buffer, and are closed when
+    sent, if they have a `close` method. Pieces of asynchronous iterators are sent as
+    soon as they are yielded, so these can be used for pushing events (ex. with
+    `text/event-stream` content type). If `Content-Length` is in `headers`, they are
+    streamed as they are instead, and files are only read up to that length (so a
+    part of a file can be sent by seeking to its start).
     """
 
     return {
@@ -201,77 +352,446 @@ def response(status, body="", content_type=CT_PLAIN, headers={}):
     }
 
 
-def readall_from(source, into=None, timeout=None, chunk_size=64):
+def file_etag(stat):
+    """
+    Return an entity tag for a file from its `stat` (as returned by `uos.stat`), made
+    of its size and modification time, so the file is not read. It may be sent in the
+    `ETag` header of responses serving the file.
+
+    None is returned if the filesystem does not keep modification times, as the tag
+    would not change when the file is rewritten with the same size.
+    """
+
+    if not stat[8]:
+        return None
+    return '"{:x}-{:x}"'.format(stat[6], stat[8])
+
+
+def not_modified(headers, etag):
+    """
+    Return a `304 Not Modified` response if `etag` matches one in the `If-None-Match`
+    header of the request (`headers` as passed to callbacks), else return None.
+
+    Ex.:
+    ```python
+    def serve_page(method, loc, params, headers, conn, addr):
+        return httpsrv.not_modified(headers, PAGE_ETAG) or httpsrv.response(
+            200, PAGE, httpsrv.CT_HTML, {"ETag": PAGE_ETAG}
+        )
+    ```
+    """
+
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is None or etag is None:
+        return None
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]  # weak comparison
+        if tag == etag or tag == "*":
+            return response(304, headers={"ETag": etag})
+    return None
+
+
+def accepts_encoding(headers, coding):
+    """
+    Return True if the `Accept-Encoding` header of the request (`headers` as passed to
+    callbacks) accepts content coding `coding` (ex. "gzip").
+    """
+
+    value = headers.get("accept-encoding")
+    if value is None:
+        return False
+    for item in value.split(","):
+        params = item.split(";")
+        if params[0].strip().lower() == coding:
+            for param in params[1:]:
+                param = param.strip().replace(" ", "")
+                try:
+                    if param.startswith("q=") and not float(param[2:] or 0):
+                        return False
+                except ValueError:
+                    pass
+            return True
+    return False
+
+
+def byte_range(headers, size, etag=None):
+    """
+    Return the byte range asked for in the `Range` header of the request (`headers` as
+    passed to callbacks), for a resource of `size` bytes, as a tuple of `(start, stop)`
+    (stop being exclusive).
+
+    None is returned if the whole resource should be sent, which is when there's no
+    `Range` header, it's invalid, it asks for multiple ranges, or an `If-Range` header
+    doesn't match `etag`. If the range can't be satisfied, start is equal to stop, and
+    a `416 Range Not Satisfiable` response should be sent.
+    """
+
+    value = headers.get("range")
+    if value is None or not value.startswith("bytes=") or "," in value:
+        return None
+    if_range = headers.get("if-range")
+    if if_range is not None and if_range != etag:
+        return None
+
+    bounds = value[6:].strip().split("-", 1)
+    if len(bounds) != 2:
+        return None
+    first, last = bounds
+    # int() would take signs and spaces too
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        if not last:
+            return None
+        # suffix range, the last bytes of the resource
+        return (max(size - int(last), 0), size)
+    start = int(first)
+    stop = int(last) + 1 if last else size
+    if start >= size:
+        return (size, size)
+    if stop <= start:
+        return None
+    return (start, min(stop, size))
+
+
+def transfer(source, into, size=None, buf=None):
+    """
+    Copy from `source` to `into` (socket or file-like objects) until the end of
+    `source`, or at most `size` bytes if given, and return the number of bytes copied.
+
+    Data is read into `buf` (a bytearray, a new one of 1024 bytes if not given) with
+    readinto (or read, if `source` has no readinto), and written from it only when
+    it's full, or at the end. This way, writing to a file is done in whole buffers, so
+    the size of `buf` should be a multiple of the flash block size. A bigger buffer
+    means fewer, bigger reads and writes, and faster transfers, at the cost of memory.
+    The same buffer may be passed to many transfers, so it's only allocated once.
+
+    Reading from `conn` stops at the end of the request body. A timeout while reading
+    ends the transfer, just as the end of `source` does.
+    """
+
+    if buf is None:
+        buf = bytearray(_transfer_size)
+    buf_mv = memoryview(buf)
+    readinto = hasattr(source, "readinto")
+    copied = 0
+    filled = 0
+    while size is None or copied + filled < size:
+        stop = len(buf) if size is None else min(len(buf), size - copied)
+        try:
+            if readinto:
+                count = source.readinto(buf_mv[filled:stop])
+            else:
+                data = source.read(stop - filled) or b""
+                count = len(data)
+                buf_mv[filled:filled + count] = data
+        except OSError as exc:
+            if exc.args[0] == uerrno.ETIMEDOUT:
+                break
+            raise
+        if not count:
+            break
+        filled += count
+        if filled == len(buf):
+            into.write(buf_mv)
+            copied += filled
+            filled = 0
+    if filled:
+        into.write(buf_mv[:filled])
+        copied += filled
+    return copied
+
+
+async def atransfer(conn, into, size=None, buf=None):
+    """
+    Same as `transfer`, but reading the request body from `conn` (as passed to
+    callbacks) with `aread`, so a coroutine callback does not block the event loop
+    while receiving. Data is written to `into` in whole buffers all the same.
+    """
+
+    if buf is None:
+        buf = bytearray(_transfer_size)
+    buf_mv = memoryview(buf)
+    copied = 0
+    filled = 0
+    while size is None or copied + filled < size:
+        stop = len(buf) if size is None else min(len(buf), size - copied)
+        try:
+            data = await conn.aread(stop - filled)
+        except uasyncio.TimeoutError:
+            break
+        if not data:
+            break
+        buf_mv[filled:filled + len(data)] = data
+        filled += len(data)
+        if filled == len(buf):
+            into.write(buf_mv)
+            copied += filled
+            filled = 0
+    if filled:
+        into.write(buf_mv[:filled])
+        copied += filled
+    return copied
+
+
+def readall_from(source, into=None, timeout=None, chunk_size=_transfer_size):
     """
     This function can be used to read from a socket or file-like object into another
-    socket or file-like object. `timeout` is only relevant for socket objects.
+    socket or file-like object. `timeout` is only relevant for socket objects and
+    `conn` objects passed to callbacks. Data is copied through a buffer of
+    `chunk_size` bytes (see transfer).
+
+    Reading from `conn` stops at the end of the request body.
     """
 
     if timeout is not None:
-        if isinstance(source, socket.socket):
+        if isinstance(source, (socket.socket, Connection)):
             source.settimeout(timeout)
-        if isinstance(into, socket.socket):
+        if isinstance(into, (socket.socket, Connection)):
             into.settimeout(timeout)
 
     if into is None:
         into = uio.BytesIO()
 
-    data = b""
-    while True:
-        try:
-            if isinstance(source, socket.socket):
-                data = source.recv(chunk_size)
-            else:
-                data = source.read(chunk_size)
-            if data:
-                into.write(data)
-            else:
-                break
-        except OSError as exc:
-            if exc.args[0] == uerrno.ETIMEDOUT:
-                if not data:
-                    break  # will break on second timeout event
-                data = b""
-            else:
-                raise exc
-
+    transfer(source, into, buf=bytearray(chunk_size))
     return into
 
 
+def _status_line(status):
+    # encoded status lines are cached, as they are sent with every response
+    if status not in _status_lines:
+        _status_lines[status] = "{} {} {}\r\n".format(
+            _http_ver, status, _statuses[status]
+        ).encode()
+    return _status_lines[status]
+
+
+def _put(pos, data):
+    # copy data into the head buffer at pos, growing the buffer if it does not fit
+    global _head_buf, _head_mv
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    end = pos + len(data)
+    if end > len(_head_buf):
+        grown = bytearray(end + 64)
+        grown[:pos] = _head_mv[:pos]
+        _head_buf = grown
+        _head_mv = memoryview(grown)
+
+    _head_mv[pos:end] = data
+    return end
+
+
+def _head(status, content_type, headers, length=None, keep_alive=False, chunked=False):
+    # Assemble the status line and headers in the reusable head buffer. The returned
+    # memoryview is only valid until the next call, so it must be written out before
+    # awaiting anything.
+    pos = _put(0, _status_line(status))
+    pos = _put(pos, b"Content-type: ")
+    pos = _put(pos, content_type)
+    if length is not None:
+        pos = _put(pos, b"\r\nContent-Length: ")
+        pos = _put(pos, str(length))
+    elif chunked:
+        pos = _put(pos, b"\r\nTransfer-Encoding: chunked")
+    if keep_alive:
+        pos = _put(pos, b"\r\nConnection: keep-alive\r\n")
+    else:
+        pos = _put(pos, b"\r\nConnection: close\r\n")
+    for key in headers:
+        pos = _put(pos, key)
+        pos = _put(pos, b": ")
+        pos = _put(pos, str(headers[key]))
+        pos = _put(pos, b"\r\n")
+    pos = _put(pos, b"\r\n")
+    return _head_mv[:pos]
+
+
+def _get_header(headers, name):
+    for key in headers:
+        if key.lower() == name:
+            return headers[key]
+    return None
+
+
+def _has_header(headers, name):
+    return _get_header(headers, name) is not None
+
+
+def _encode_body(body):
+    # bytes-like bodies are sent as they are, anything else is sent as a string
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return body
+    return str(body).encode()
+
+
 def send_response(conn, status, body="", content_type=CT_PLAIN, headers={}):
     """
-    This function can be used to send an HTTP response to the `conn` socket.
+    This function can be used to send an HTTP response to `conn`.
 
     It can be useful for only sending status and headers (leaving the body empty), then
-    the body can be sent by writing to `conn` directly.
+    the body can be sent by writing to `conn` directly. `Content-Length` is added
+    automatically if `body` is not empty, and it's not in `headers` already.
+
+    `body` may be a string, or a bytes-like object, which is sent without copying.
     """
 
-    # discard rest of request
-    conn.settimeout(0.5)
-    while True:
-        try:
-            if not conn.recv(64):
-                break
-        except OSError:
-            break
+    body = _encode_body(body)
+    length = len(body) if body and not _has_header(headers, "content-length") else None
+    conn.write(_head(status, content_type, headers, length))
+    if body:
+        conn.write(body)
 
-    response = (
-        "{0} {1} {2}\r\n"
-        "Content-type: {3}\r\n"
-        "Connection: close\r\n"
-        "{4}"
-        "\r\n"
-        "{5}".format(
-            _http_ver,
-            status,
-            _statuses[status],
-            content_type,
-            "\r\n".join(["{}: {}".format(key, headers[key]) for key in headers] + [""]),
-            body,
-        )
+
+async def _write(writer, data):
+    # Write data in bounded slices, so the stream never holds a full copy of it.
+    # bytes are immutable, so these can be handed to the stream as they are.
+    if isinstance(data, bytes):
+        writer.write(data)
+        await writer.drain()
+        return
+
+    data_mv = memoryview(data)
+    for pos in range(0, len(data_mv), _write_slice):
+        writer.write(data_mv[pos:pos + _write_slice])
+        await writer.drain()
+
+
+def _is_stream(body):
+    return not isinstance(body, (str, bytes, bytearray, memoryview)) and (
+        hasattr(body, "read") or hasattr(body, "__next__") or hasattr(body, "__anext__")
     )
 
-    conn.write(response.encode())  # noqa
+
+class _BodyStreamer:
+    # Writes a streamed body through a fixed buffer, as chunks if chunked is set.
+    # Files are read until the end, or until limit bytes are sent, if it's given.
+
+    def __init__(self, writer, chunked, limit=None):
+        self._writer = writer
+        self._chunked = chunked
+        self._buf = bytearray(_stream_buf_size)
+        self._buf_mv = memoryview(self._buf)
+        self._fill = 0
+        self._limit = limit
+        self.sent = 0
+
+    async def send(self, body):
+        if hasattr(body, "read"):
+            await self._send_file(body)
+        elif hasattr(body, "__anext__"):
+            async for piece in body:
+                await self._add(piece)
+                await self._flush()  # the next piece may take a while
+        else:
+            for piece in body:
+                await self._add(piece)
+
+        await self._flush()
+        if self._chunked:
+            self._writer.write(b"0\r\n\r\n")
+            await self._writer.drain()
+
+    async def _send_file(self, file):
+        left = self._limit
+        while left is None or left > 0:
+            size = len(self._buf) if left is None else min(len(self._buf), left)
+            if hasattr(file, "readinto"):
+                count = file.readinto(self._buf_mv[:size])
+            else:
+                data = file.read(size)
+                count = len(data)
+                self._buf_mv[:count] = data
+            if not count:
+                break
+            if left is not None:
+                left -= count
+            self._fill = count
+            await self._flush()
+
+    async def _add(self, piece):
+        if isinstance(piece, str):
+            piece = piece.encode()
+
+        size = len(piece)
+        if self._fill + size > len(self._buf):
+            await self._flush()
+            if size > len(self._buf):
+                await self._write_chunk(piece)
+                return
+
+        self._buf_mv[self._fill:self._fill + size] = piece
+        self._fill += size
+
+    async def _flush(self):
+        if self._fill:
+            await self._write_chunk(self._buf_mv[:self._fill])
+            self._fill = 0
+
+    async def _write_chunk(self, data):
+        self.sent += len(data)
+        if self._chunked:
+            self._writer.write("{:x}\r\n".format(len(data)).encode())
+        await _write(self._writer, data)
+        if self._chunked:
+            self._writer.write(b"\r\n")
+
+
+async def _send_response(
+    writer,
+    status,
+    body="",
+    content_type=CT_PLAIN,
+    headers={},
+    head_only=False,
+    keep_alive=False,
+    chunked=True,
+):
+    # Send the response, and return whether the connection may be kept alive, and the
+    # number of bytes sent (not counting chunk framing).
+    # A streamed body is sent chunked, unless chunked is False (ex. for HTTP/1.0), in
+    # which case the end of the body is marked by closing the connection.
+
+    if _is_stream(body):
+        try:
+            limit = _get_header(headers, "content-length")
+            if limit is not None:
+                chunked = False
+                limit = int(limit)
+            elif not chunked:
+                keep_alive = False
+            head = _head(status, content_type, headers, None, keep_alive, chunked)
+            sent = len(head)
+            writer.write(head)
+            if head_only:
+                await writer.drain()
+            else:
+                streamer = _BodyStreamer(writer, chunked, limit)
+                await streamer.send(body)
+                sent += streamer.sent
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        return keep_alive, sent
+
+    body = _encode_body(body)
+    length = None
+    if status != 304 and not _has_header(headers, "content-length"):
+        length = len(body)  # a 304 response never has a body
+    # the head is copied by the stream
+    head = _head(status, content_type, headers, length, keep_alive)
+    sent = len(head)
+    writer.write(head)
+    if body and not head_only:
+        await _write(writer, body)
+        sent += len(body)
+    else:
+        await writer.drain()
+    return keep_alive, sent
 
 
 def error_view(exc):
@@ -312,6 +832,121 @@ def error_view(exc):
     )
 
 
+def _read_line_part(reader, limit):
+    # Read at most limit bytes from reader (a uasyncio Stream), stopping after a line
+    # break, like Stream.readline does (a generator to be awaited, as uasyncio
+    # coroutines are). The part of a line available is returned, which is empty at the
+    # end of the stream.
+    while True:
+        yield uasyncio.core._io_queue.queue_read(reader.s)
+        part = reader.s.readline(limit)
+        if part is not None:  # else nothing to read yet
+            return part
+
+
+def _readline(reader, limit):
+    # Read a line of at most limit bytes from reader (a generator to be awaited, see
+    # _read_line_part). Return None as soon as the line turns out to be longer, leaving
+    # the rest of it unread, so a long line is never held in memory.
+    line = b""
+    while True:
+        piece = yield from _read_line_part(reader, limit - len(line))
+        line += piece
+        if not piece or line[-1] == 10:  # end of the stream, or of the line
+            return line
+        if len(line) >= limit:
+            return None
+
+
+def _parse_request_line(line):
+    # Parse b"METHOD /path?query HTTP/x.y\r\n" in one left-to-right pass. Returns the
+    # method and the unencoded path as strings, the raw query as bytes (or None), and
+    # whether the request is HTTP/1.0.
+    method_end = line.find(b" ")
+    target_end = line.find(b" ", method_end + 1)
+
+    if (
+        method_end < 1
+        or target_end < 0  # noqa
+        or line[method_end + 1] != 47  # noqa (b"/")
+        or not line.startswith(b"HTTP/", target_end + 1)  # noqa
+    ):
+        raise URLInvalidError
+
+    query_start = line.find(b"?", method_end + 1, target_end)
+    http10 = line.startswith(b"HTTP/1.0", target_end + 1)
+
+    try:
+        method = line[:method_end].decode()
+        if query_start < 0:
+            return method, _unquote(line, method_end + 1, target_end), None, http10
+        return (
+            method,
+            _unquote(line, method_end + 1, query_start),
+            line[query_start + 1:target_end],
+            http10,
+        )
+    except UnicodeError:
+        raise URLInvalidError
+
+
+def _parse_query(query):
+    # Parse b"key=value&key&..." into a dict. A key without "=" gets None as value, and
+    # a key repeated in the query gets a list of all its values.
+    params = {}
+    start = 0
+    end = len(query)
+
+    while start < end:
+        param_end = query.find(b"&", start)
+        if param_end < 0:
+            param_end = end
+
+        if param_end > start:
+            eq = query.find(b"=", start, param_end)
+            if eq < 0:
+                key = _unquote(query, start, param_end)
+                value = None
+            else:
+                key = _unquote(query, start, eq)
+                value = _unquote(query, eq + 1, param_end)
+
+            if key not in params:
+                params[key] = value
+            elif isinstance(params[key], list):
+                params[key].append(value)
+            else:
+                params[key] = [params[key], value]
+
+        start = param_end + 1
+
+    return params
+
+
+def _chunk_size(line):
+    # parse the size line of a chunk (b"1a;ext=1\r\n")
+    ext = line.find(b";")
+    return int(line[:ext] if ext >= 0 else line, 16)
+
+
+def _split_rule(location_re):
+    # Split an anchored rule into its literal prefix and the rest of the regex.
+    if not location_re.startswith("^"):
+        return "", location_re
+
+    idx = 1
+    while idx < len(location_re) and location_re[idx] not in _regex_special:
+        idx += 1
+
+    prefix = location_re[1:idx]
+    rest = location_re[idx:]
+    if rest and rest[0] in "*+?{":
+        # the quantifier applies to the last character, which is then not literal
+        return prefix[:-1], location_re[idx - 1:]
+
+    return prefix, rest
+
+
 class NoMethodError(Exception):
     """
     Raised when the method requested is not registered to any callbacks. This error is
@@ -343,30 +978,696 @@ class URLInvalidError(Exception):
     pass
 
 
+class Request:
+    """
+    Passed to callbacks registered with `request=True`, this object holds the request.
+
+    Attributes are `method`, `path` (the URL without the query, un-encoded), `headers`
+    (a `Headers` object), `conn` (a `Connection` object) and `addr` (the client
+    address). `params` (the query parameters, see `HTTPServer`) and `body` (the whole
+    request body as bytes) are only computed when first accessed. For large bodies, read
+    from `conn` instead of accessing `body`.
+    """
+
+    __slots__ = (
+        "method",
+        "path",
+        "headers",
+        "conn",
+        "addr",
+        "_query",
+        "_params",
+        "_body",
+    )
+
+    def __init__(self, method, path, query, headers, conn, addr):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.conn = conn
+        self.addr = addr
+        self._query = query
+        self._params = None
+        self._body = None
+
+    @property
+    def params(self):
+        if self._params is None:
+            self._params = _parse_query(self._query) if self._query else {}
+        return self._params
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = readall_from(self.conn).getvalue()
+        return self._body
+
+    async def read_body(self):
+        """
+        Read and return the whole request body like `body` does, but without blocking
+        the event loop. To be used in coroutine callbacks.
+        """
+
+        if self._body is None:
+            body = uio.BytesIO()
+            while True:
+                data = await self.conn.aread(_read_size)
+                if not data:
+                    break
+                body.write(data)
+            self._body = body.getvalue()
+        return self._body
+
+
+class Response:
+    """
+    A response, which may be returned by callbacks instead of the dict returned by
+    `response`. It takes the same arguments as `response`.
+    """
+
+    __slots__ = ("status", "body", "content_type", "headers")
+
+    def __init__(self, status, body="", content_type=CT_PLAIN, headers={}):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers
+
+
+class PreparedResponse:
+    """
+    A response serialized once, as returned by `prepare`. Callbacks may return it like
+    a `Response`, and it's sent with a single write.
+    """
+
+    __slots__ = ("_keep_alive", "_close")
+
+    def __init__(self, status, body="", content_type=CT_PLAIN, headers={}):
+        if _is_stream(body):
+            raise ValueError("streamed body can't be prepared")
+        body = _encode_body(body)
+        length = None if _has_header(headers, "content-length") else len(body)
+        # (response, length of head) for both values of the Connection header
+        head = bytes(_head(status, content_type, headers, length, True))
+        self._keep_alive = (head + body, len(head))
+        head = bytes(_head(status, content_type, headers, length, False))
+        self._close = (head + body, len(head))
+
+    async def _send(self, writer, keep_alive, head_only):
+        data, head_len = self._keep_alive if keep_alive else self._close
+        if head_only:
+            data = memoryview(data)[:head_len]
+        writer.write(data)
+        await writer.drain()
+        return keep_alive, len(data)
+
+
+def prepare(status, body="", content_type=CT_PLAIN, headers={}):
+    """
+    Return a `PreparedResponse`, taking the same arguments as `response`.
+
+    The status line, headers and body are serialized once, so sending the response
+    costs no further allocation. This is useful for constant responses, which should be
+    prepared once, outside of the callback. `body` can't be a streamed body.
+    """
+
+    return PreparedResponse(status, body, content_type, headers)
+
+
+class Headers:
+    """
+    Passed to callbacks as `headers`, this object holds the request headers.
+
+    It can be used like a read-only dict, with header names being case-insensitive.
+    Names are lower case when iterated over. If a header is repeated in the request,
+    only the first one is accessible.
+
+    Headers are kept as received in a single buffer. Looking up a header scans the
+    buffer, and the buffer is only parsed into a dict when iterated over.
+    """
+
+    def __init__(self):
+        self._raw = bytearray(b"\n")  # b"\nname: value\r\nname: value\r\n..."
+        self._dict = None
+        self._count = 0
+        self._size = 0  # bytes of the header lines received
+
+    def _add(self, line):
+        # add a received header line, with the name converted to lower case
+        colon = line.find(b":")
+        if colon > 0:
+            self._raw.extend(line[:colon].lower())
+            self._raw.extend(memoryview(line)[colon:])
+            self._count += 1
+
+    def _received(self):
+        # all header lines are added, convert the buffer to bytes, which can be searched
+        self._size = len(self._raw) + 1  # lines and the empty line, minus the first \n
+        self._raw = bytes(self._raw)
+
+    def get(self, name, default=None):
+        if self._dict is not None:
+            return self._dict.get(name.lower(), default)
+
+        start = self._raw.find(b"\n" + name.lower().encode() + b":")
+        if start < 0:
+            return default
+        start += len(name) + 2
+        end = self._raw.find(b"\n", start)
+        return self._raw[start:end if end >= 0 else len(self._raw)].decode().strip()
+
+    def _parsed(self):
+        if self._dict is None:
+            headers = {}
+            for line in self._raw.decode().split("\n"):
+                colon = line.find(":")
+                if colon > 0 and line[:colon] not in headers:
+                    headers[line[:colon]] = line[colon + 1:].strip()
+            self._dict = headers
+            self._raw = None
+        return self._dict
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __iter__(self):
+        return iter(self._parsed())
+
+    def __len__(self):
+        return len(self._parsed())
+
+    def keys(self):
+        return self._parsed().keys()
+
+    def values(self):
+        return self._parsed().values()
+
+    def items(self):
+        return self._parsed().items()
+
+
+class Connection(uio.IOBase):
+    """
+    Passed to callbacks as `conn`, this object wraps the socket of the connection.
+
+    Reading from it (with `read`, `recv` or `readinto`) returns the request body only.
+    At most the number of bytes given in the `Content-Length` request header is read,
+    and a body sent with chunked transfer-encoding is decoded. Once the body is read
+    completely, reading returns an empty bytes object, so for example
+    `transfer(conn, file)` returns as soon as the body is received. The part of the body
+    a callback does not read is skipped after the callback returns.
+
+    Writing to it (with `write` or `send`) writes to the socket directly.
+
+    `read` and `write` block until done. In coroutine callbacks use `aread`, `areadline`
+    and `awrite` instead, which yield to the event loop while waiting on the socket.
+
+    It's a stream, so it can be wrapped by MicroPython stream wrappers, ex.
+    `uzlib.DecompIO(conn, 31)` reads a gzip compressed body decompressed.
+    """
+
+    def __init__(self, reader, writer, headers):
+        self._reader = reader
+        self._writer = writer
+        self._sock = writer.s
+        self._timeout = None
+        self._chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self._started = False
+        self._received = 0  # bytes of the body read
+        self._truncated = False
+        self._stream = False  # see HTTPServer.open_stream
+        # bytes left of the body, or of the current chunk if the body is chunked
+        self._left = (
+            0 if self._chunked else int(headers.get("content-length", 0))
+        )
+
+    def received_all(self):
+        """
+        Return True if the whole request body has been read. Reading stops early,
+        without an error, if the client closes the connection, or if reading times out
+        (see `transfer`), which can be told apart with this.
+        """
+
+        return self._left == 0 and not self._chunked and not self._truncated
+
+    def settimeout(self, value):
+        self._timeout = value
+        self._sock.settimeout(value)
+
+    def setblocking(self, flag):
+        self._sock.setblocking(flag)
+
+    def write(self, data):
+        return self._sock.write(data)
+
+    send = write
+
+    def read(self, size=-1):
+        if self._left == 0 and self._chunked:
+            self._set_chunk(self._read_chunk_head())
+
+        if size < 0 or size > self._left:
+            size = self._left
+        if size == 0:
+            return b""
+
+        data = self._sock.recv(size)
+        self._set_read(len(data))
+        return data
+
+    recv = read
+
+    def readinto(self, buf):
+        if self._left == 0 and self._chunked:
+            self._set_chunk(self._read_chunk_head())
+
+        size = min(len(buf), self._left)
+        if size == 0:
+            return 0
+
+        count = self._sock.readinto(memoryview(buf)[:size])
+        self._set_read(count)
+        return count
+
+    def _read_chunk_head(self):
+        if self._started:
+            self._sock.readline()  # line break after previous chunk
+        self._started = True
+        line = self._sock.readline()
+        if line and _chunk_size(line) == 0:
+            while self._sock.readline() not in (b"\r\n", b""):
+                pass  # skip trailer
+        return line
+
+    async def aread(self, size=-1):
+        """
+        Read at most `size` bytes of the request body (everything available if `size`
+        is not given) without blocking the event loop. Return an empty bytes object at
+        the end of the body.
+        """
+
+        if self._left == 0 and self._chunked:
+            self._set_chunk(await self._aread_chunk_head())
+
+        if size < 0 or size > self._left:
+            size = self._left
+        if size == 0:
+            return b""
+
+        data = await self._wait(self._reader.read(size))
+        self._set_read(len(data))
+        return data
+
+    async def areadline(self, buf):
+        """
+        Read a line of the request body into `buf` (a bytearray) without blocking the
+        event loop, up to and including the line break. Return the number of bytes
+        read, which is 0 at the end of the body. A line longer than `buf` fills it, and
+        the rest of the line is left to be read.
+        """
+
+        count = 0
+        while count < len(buf):
+            if self._left == 0 and self._chunked:
+                self._set_chunk(await self._aread_chunk_head())
+            size = min(len(buf) - count, self._left)
+            if size == 0:
+                break
+            part = await self._wait(_read_line_part(self._reader, size))
+            self._set_read(len(part))
+            buf[count:count + len(part)] = part
+            count += len(part)
+            if not part or part[-1] == 10:
+                break
+        return count
+
+    async def awrite(self, data):
+        """
+        Write `data` (a bytes-like object) to the connection without blocking the event
+        loop.
+        """
+
+        await _write(self._writer, data)
+
+    async def _aread_chunk_head(self):
+        if self._started:
+            await self._wait(self._reader.readline())  # line break after previous chunk
+        self._started = True
+        line = await self._wait(self._reader.readline())
+        if line and _chunk_size(line) == 0:
+            while (await self._wait(self._reader.readline())) not in (b"\r\n", b""):
+                pass  # skip trailer
+        return line
+
+    async def _wait(self, coro):
+        # wait for a read, with the connection timeout if set
+        if self._timeout is None:
+            return await coro
+        return await uasyncio.wait_for(coro, self._timeout)
+
+    def _set_chunk(self, line):
+        if not line:
+            self._set_read(0)  # closed where a chunk was expected
+            return
+        self._left = _chunk_size(line)
+        if self._left == 0:
+            self._chunked = False  # last chunk, body is over
+
+    def _set_read(self, count):
+        if count == 0:
+            # connection closed before the end of the body
+            self._left = 0
+            self._chunked = False
+            self._truncated = True
+        else:
+            self._left -= count
+            self._received += count
+
+    async def _skip(self):
+        while await self.aread(_read_size):
+            pass
+
+
+async def accept_websocket(conn, headers, max_size=512):
+    """
+    Accept a WebSocket upgrade request, and return a `WebSocket`. To be used in
+    coroutine callbacks, which should return None when done with the WebSocket.
+
+    None is returned if the request is not a WebSocket upgrade request, in which case
+    the callback should return an error response.
+
+    Ex.:
+    ```python
+    async def echo(method, loc, params, headers, conn, addr):
+        ws = await httpsrv.accept_websocket(conn, headers)
+        if ws is None:
+            return httpsrv.response(404)
+        while True:
+            message = await ws.receive()
+            if message is None:
+                return None
+            await ws.send(message)
+    ```
+    """
+
+    key = headers.get("sec-websocket-key")
+    if key is None or "websocket" not in headers.get("upgrade", "").lower():
+        return None
+
+    accept = ubinascii.b2a_base64(uhashlib.sha1(key.encode() + _ws_guid).digest())
+    conn._writer.write(
+        b"HTTP/1.1 101 Switching Protocols\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n"
+        b"Sec-WebSocket-Accept: "
+    )
+    conn._writer.write(accept.strip())
+    conn._writer.write(b"\r\n\r\n")
+    await conn._writer.drain()
+    return WebSocket(conn._reader, conn._writer, max_size)
+
+
+class WebSocket:
+    """
+    A WebSocket connection, as returned by `accept_websocket`.
+
+    Messages of at most `max_size` bytes are received, larger ones close the WebSocket
+    with status 1009. `closed` is True once the WebSocket is closed.
+
+    Messages may be sent from another task while one task is receiving.
+    """
+
+    def __init__(self, reader, writer, max_size=512):
+        self._reader = reader
+        self._writer = writer
+        self._buf = bytearray(max_size)
+        self._buf_mv = memoryview(self._buf)
+        self._control = bytearray(125)  # payload of control frames is at most this
+        self._control_mv = memoryview(self._control)
+        self._lock = uasyncio.Lock()  # frames are written whole
+        self.closed = False
+
+    async def receive(self):
+        """
+        Wait for a message, and return it as a string for a text message, or as bytes
+        for a binary message. Return None when the WebSocket is closed.
+
+        Pings are answered while waiting. Invalid control frames close the WebSocket
+        with status 1002.
+        """
+
+        fill = 0
+        text = False
+        try:
+            while not self.closed:
+                head = await self._read(2)
+                opcode = head[0] & 0x0F
+                length = head[1] & 0x7F
+                if length >= 126:
+                    extended = await self._read(2 if length == 126 else 8)
+                    length = 0
+                    for byte in extended:
+                        length = length << 8 | byte
+                mask = await self._read(4) if head[1] & 0x80 else None
+
+                if opcode >= 0x8:
+                    # control frame, may come between the frames of a message
+                    if length > len(self._control) or not head[0] & 0x80:
+                        await self.close(1002)  # not allowed to be long or fragmented
+                        break
+                    await self._read_into(self._control_mv, 0, length)
+                    if mask is not None:
+                        _unmask(self._control, 0, length, mask)
+                    if opcode == 0x8:
+                        await self.close(
+                            bytes(self._control_mv[:2]) if length >= 2 else 1000
+                        )
+                    elif opcode == 0x9:
+                        await self._send_frame(0xA, self._control_mv[:length])  # pong
+                    continue
+
+                if fill + length > len(self._buf):
+                    await self.close(1009)
+                    break
+                await self._read_into(self._buf_mv, fill, length)
+                if mask is not None:
+                    _unmask(self._buf, fill, length, mask)
+                if opcode == 0x1:
+                    text = True
+                fill += length
+                if head[0] & 0x80:
+                    # final frame of the message
+                    if text:
+                        return str(self._buf_mv[:fill], "utf-8")
+                    return bytes(self._buf_mv[:fill])
+        except EOFError:
+            self.closed = True
+        return None
+
+    async def send(self, data):
+        """
+        Send `data` as a text message if it's a string, or as a binary message if it's a
+        bytes-like object.
+        """
+
+        if isinstance(data, str):
+            await self._send_frame(0x1, data.encode())
+        else:
+            await self._send_frame(0x2, data)
+
+    async def ping(self):
+        """
+        Send a ping. The answer is not waited for, but sending fails eventually if the
+        other end is gone.
+        """
+
+        await self._send_frame(0x9, b"")
+
+    async def close(self, code=1000):
+        """
+        Close the WebSocket with status `code`.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        if isinstance(code, int):
+            code = bytes((code >> 8, code & 0xFF))
+        try:
+            await self._send_frame(0x8, code)
+        except OSError:
+            pass
+
+    async def _read(self, size):
+        # read exactly size bytes, raise EOFError if the connection is closed
+        data = b""
+        while len(data) < size:
+            piece = await self._reader.read(size - len(data))
+            if not piece:
+                raise EOFError
+            data += piece
+        return data
+
+    async def _read_into(self, buf_mv, pos, size):
+        # read exactly size bytes into buf_mv (a memoryview) at pos
+        while size > 0:
+            piece = await self._reader.read(size)
+            if not piece:
+                raise EOFError
+            buf_mv[pos:pos + len(piece)] = piece
+            pos += len(piece)
+            size -= len(piece)
+
+    async def _send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = bytes((0x80 | opcode, length))
+        elif length < 0x10000:
+            head = bytes((0x80 | opcode, 126, length >> 8, length & 0xFF))
+        else:
+            head = bytes((0x80 | opcode, 127)) + bytes(
+                (length >> shift) & 0xFF for shift in range(56, -8, -8)
+            )
+        async with self._lock:
+            self._writer.write(head)
+            if length:
+                self._writer.write(payload)
+            await self._writer.drain()
+
+
+def _unmask(buf, start, length, mask):
+    for pos in range(length):
+        buf[start + pos] ^= mask[pos & 3]
+
+
+class _Metrics:
+    # Request counters and latency histograms per route, in a preallocated array.
+    # Recording only updates items of the array, so it does not allocate.
+
+    def __init__(self):
+        self._names = ["unmatched"]  # slot 0 is for requests not matching any route
+        self._slots = {}
+        self._counts = uarray.array("L", [0] * _metric_fields)
+
+    def slot(self, method, location_re):
+        # return the slot of a route, adding one if it's new
+        name = "{} {}".format(method, location_re)
+        if name not in self._slots:
+            self._slots[name] = len(self._names)
+            self._names.append(name)
+            self._counts.extend(uarray.array("L", [0] * _metric_fields))
+        return self._slots[name]
+
+    def count(self, slot, error=False, bytes_in=0, bytes_out=0):
+        base = slot * _metric_fields
+        self._counts[base] += 1
+        if error:
+            self._counts[base + 1] += 1
+        self._counts[base + 2] += bytes_in
+        self._counts[base + 3] += bytes_out
+
+    def time(self, slot, phase, start, end):
+        elapsed = utime.ticks_diff(end, start)
+        bucket = 0
+        while bucket < len(_metric_bounds) and elapsed > _metric_bounds[bucket]:
+            bucket += 1
+        self._counts[
+            slot * _metric_fields + 4 + phase * (len(_metric_bounds) + 1) + bucket
+        ] += 1
+
+    def export(self):
+        metrics = {"buckets_us": _metric_bounds}
+        for slot in range(len(self._names)):
+            base = slot * _metric_fields
+            if not self._counts[base]:
+                continue  # no requests
+            route = {
+                "requests": self._counts[base],
+                "errors": self._counts[base + 1],
+                "bytes_in": self._counts[base + 2],
+                "bytes_out": self._counts[base + 3],
+            }
+            pos = base + 4
+            for phase in _metric_phases:
+                route[phase] = list(self._counts[pos:pos + len(_metric_bounds) + 1])
+                pos += len(_metric_bounds) + 1
+            metrics[self._names[slot]] = route
+        return metrics
+
+
 class HTTPServer:
-    def __init__(self, port):
-        self._sock = socket.socket()
-        self._sock.bind(socket.getaddrinfo("0.0.0.0", port)[0][-1])
-        self._sock.setblocking(False)
-        self._sock.listen(1)
+    def __init__(self, port, backlog=1):
+        self._port = port
+        self._backlog = backlog
+        self._server = None
         self._timeout = 1  # seconds
-        self._callbacks = {
-            "GET": {
-                "^/$": lambda method, loc, params, headers, conn, addr: (
-                    200,
-                    '"OK"',
-                    CT_JSON,
-                )
-            }
-        }
+        self._max_connections = 4
+        self._min_free_memory = 0
+        self._connections = 0  # number of connections currently open
+        self._max_streams = 2
+        self._streams = 0  # number of connections currently open as streams
+        self._metrics = _Metrics()
+        self._keep_alive_timeout = 0  # seconds, keep-alive is disabled by default
+        self._keep_alive_requests = 0
+        self._keep_alive_connections = 0
+        self._kept_alive = 0  # number of connections currently kept alive
+        self.set_header_limits()
+        self._callbacks = {}
+        self._request_rules = set()  # (method, location_re) of Request callbacks
+        self._routes = {}
+        ok = prepare(200, '"OK"', CT_JSON)
+        self.register(
+            "GET", "^/$", lambda method, loc, params, headers, conn, addr: ok
+        )
 
     def close(self):
-        self._sock.close()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
 
     def set_timeout(self, timeout):
         self._timeout = timeout
 
-    def register(self, method, location_re, callback):
+    def set_keep_alive(self, timeout, max_requests=20, max_connections=2):
+        """
+        Enable persistent connections (HTTP keep-alive), so a client may send further
+        requests on the same connection, instead of connecting again for each request.
+        This is disabled by default.
+
+        A kept-alive connection is closed if no new request arrives for `timeout`
+        seconds, or after `max_requests` requests. At most `max_connections` connections
+        are kept alive at the same time, other connections are closed after the first
+        response as usual. Pass a `timeout` of 0 to disable keep-alive again.
+
+        Only responses returned by callbacks can keep a connection alive. If a callback
+        sends the response itself, the connection is always closed.
+        """
+
+        self._keep_alive_timeout = timeout
+        self._keep_alive_requests = max_requests
+        self._keep_alive_connections = max_connections
+
+    def register(self, method, location_re, callback, request=False):
+        """
+        Register `callback` to be called for requests with `method` on URLs matching
+        the regex rule `location_re`.
+
+        The callback is called with the arguments `(method, loc, params, headers, conn,
+        addr)`. If `request` is True, it's called with a single `Request` object
+        instead. It must return a response (see `response`, `Response` and `prepare`),
+        or None if it sent the response itself.
+
+        The callback may be a coroutine function, which is then awaited, so it can do
+        longer work without blocking other tasks. It should use `conn.aread` and
+        `conn.awrite` (or `Request.read_body`) for reading and writing the connection.
+        """
+
         if method not in ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]:
             raise ValueError("method invalid")
 
@@ -375,101 +1676,395 @@ class HTTPServer:
         else:
             self._callbacks[method] = {location_re: callback}
 
+        if request:
+            self._request_rules.add((method, location_re))
+        else:
+            self._request_rules.discard((method, location_re))
+
+        self._build_routes(method)
+
     def deregister(self, method, location_re):
         del self._callbacks[method][location_re]
+        self._request_rules.discard((method, location_re))
+        self._build_routes(method)
 
     def get_registered(self):
         return self._callbacks
 
-    async def processor(self, conn, addr):
-        request_line = conn.readline().decode()
+    def get_metrics(self):
+        """
+        Return request metrics per route, as a dict keyed by `"<method> <location_re>"`
+        (with `"unmatched"` for requests not matching any route), for routes having had
+        requests.
+
+        For every route the number of `requests`, `errors` (exceptions raised while
+        handling the request, or sending the response), `bytes_in` (request line,
+        headers and body read) and `bytes_out` (response head and body) is given, along
+        with histograms of the time spent receiving and parsing the request (`parse`),
+        in the callback (`handler`) and sending the response (`send`). Histograms are
+        lists of counts, for buckets with the upper bounds in microseconds given in
+        `buckets_us`, and a last bucket for anything above.
+        """
+
+        return self._metrics.export()
+
+    def _build_routes(self, method):
+        # Rules are compiled once here. Rules of the form "^/literal$" go into a dict,
+        # rules of the form "^/literal.*" (or "^/literal") are plain prefix matches, and
+        # any other rule is a compiled regex, guarded by its literal prefix. Prefixes
+        # are checked longest first.
+        literals = {}
+        prefixed = []
+
+        for location_re in self._callbacks[method]:
+            callback = (
+                self._callbacks[method][location_re],
+                (method, location_re) in self._request_rules,
+                self._metrics.slot(method, location_re),
+            )
+            prefix, rest = _split_rule(location_re)
+
+            if rest == "$":
+                literals[prefix] = callback
+            elif rest == "" or rest == ".*":
+                prefixed.append((prefix, None, callback))
+            else:
+                if "|" in rest:
+                    prefix = ""  # alternation may escape the literal prefix
+                prefixed.append((prefix, ure.compile(location_re), callback))
 
-        header_lines = []
-        while True:
-            header_line = conn.readline()
-            if header_line == b"\r\n":
-                break
-            header_lines.append(header_line.decode())
+        prefixed.sort(key=lambda route: len(route[0]), reverse=True)
+        self._routes[method] = (literals, prefixed)
 
-        match = ure.search(
-            "([A-Z]+) ((\/[{0}]*)+)\??([{0}|\=|\&]+)? HTTP".format(
-                "a-z|A-Z|0-9|\.|\%|\-|\_|\~"
-            ),
-            request_line,
-        )  # noqa
+    def _resolve(self, method, location):
+        if method not in self._routes:
+            raise NoMethodError
 
-        if not match:
-            raise URLInvalidError
+        literals, prefixed = self._routes[method]
+
+        if location in literals:
+            return literals[location]
+
+        for prefix, regex, callback in prefixed:
+            if location.startswith(prefix) and (
+                regex is None or regex.search(location) is not None
+            ):
+                return callback
+
+        raise NoCallbackError
+
+    def set_load_limits(self, max_connections=4, min_free_memory=0, max_streams=2):
+        """
+        Limit the load on the server. At most `max_connections` connections are
+        processed at the same time, and new connections are only processed if at least
+        `min_free_memory` bytes of memory is free (checked after a garbage collection).
+        Other connections get a `503 Service Unavailable` response right away, with a
+        `Retry-After` header.
+
+        Connections opened as streams (see `open_stream`) are not counted in
+        `max_connections`, at most `max_streams` of them may be open at the same time.
+
+        Pending connections are queued by the network stack, their number is set by the
+        `backlog` argument of `HTTPServer`.
+        """
+
+        self._max_connections = max_connections
+        self._min_free_memory = min_free_memory
+        self._max_streams = max_streams
+
+    def open_stream(self, conn):
+        """
+        Count the connection `conn` (as passed to callbacks) as a long-lived stream
+        (ex. server-sent events or a WebSocket) until the request is done. Streams are
+        limited by `max_streams` of `set_load_limits` instead of `max_connections`, so
+        held-open streams do not make the server turn away other requests.
+
+        Return False if `max_streams` streams are already open, in which case the
+        callback should respond with `503 Service Unavailable` instead of streaming.
+        """
+
+        if conn._stream:
+            return True
+        if self._streams >= self._max_streams:
+            return False
+        conn._stream = True
+        self._streams += 1
+        self._connections -= 1
+        return True
+
+    def _overloaded(self):
+        if self._connections >= self._max_connections:
+            return True
+        if gc.mem_free() < self._min_free_memory:
+            gc.collect()
+            return gc.mem_free() < self._min_free_memory
+        return False
+
+    def set_header_limits(self, max_count=24, max_size=1024):
+        """
+        Set the maximum number of request headers, and their maximum total size in
+        bytes. Requests exceeding these get a `431 Request Header Fields Too Large`
+        response. The request line is limited to `max_size` bytes as well, longer ones
+        get a `414 URI Too Long` response.
+
+        Lines are read up to the limit only, so an overlong request is answered as
+        soon as the limit is crossed, without holding it in memory.
+        """
+
+        self._max_headers = max_count
+        self._max_headers_size = max_size
+
+    async def _read_headers(self, reader):
+        # Read header lines into a Headers object. Return None as soon as the headers
+        # exceed the limits, leaving the rest of them unread.
+        headers = Headers()
+        while True:
+            # the empty line ending the headers always fits
+            header_line = await _readline(
+                reader, max(self._max_headers_size - len(headers._raw), 2)
+            )
+            if header_line is None:
+                return None
+            if header_line == b"\r\n" or not header_line:
+                break
 
-        method = match.group(1)
-        location = unencode(match.group(2))
+            if (
+                headers._count >= self._max_headers
+                or len(headers._raw) + len(header_line) > self._max_headers_size
+            ):
+                return None
+            headers._add(header_line)
+
+        headers._received()
+        return headers
+
+    async def _discard_head(self, reader):
+        # read the request line and headers, up to the header size limit, and drop them
+        left = self._max_headers_size
+        while left > 0:
+            line = await _readline(reader, left)
+            if not line or line == b"\r\n":
+                break  # too long, closed, or the end of the headers
+            left -= len(line)
+
+    async def processor(self, reader, writer, addr, keep_alive=False, idle=None):
+        # Process a single request on the connection. Return True if the connection is
+        # to be kept alive for another request. The request line is awaited for `idle`
+        # seconds if given (when waiting on a kept-alive connection).
+        request_line = await uasyncio.wait_for(
+            _readline(reader, self._max_headers_size),
+            idle if idle is not None else self._timeout,
+        )
+        if not request_line:
+            if request_line is None:
+                await _send_response(writer, 414)
+                self._metrics.count(0, True, self._max_headers_size)
+            return False  # connection closed by client, or request line too long
 
-        # extract query parameters
-        params_str = match.group(4)
+        metrics = self._metrics
+        started = utime.ticks_us()
 
-        if params_str:
-            params = {
-                unencode(key): unencode(value)
-                for (key, value) in [
-                    (param.split("=")[0], param.split("=")[1])
-                    if "=" in param
-                    else (param, None)
-                    for param in params_str.split("&")
-                ]
-            }
-        else:
-            params = {}
-
-        # extract headers
-        if header_lines:
-            headers = {
-                key: value
-                for (key, value) in [
-                    (line.split(":")[0].strip(), line.split(":")[1].strip())
-                    for line in header_lines
-                ]
-            }
-        else:
-            headers = {}
+        headers = None
+        try:
+            headers = await uasyncio.wait_for(
+                self._read_headers(reader), self._timeout
+            )
+            if headers is None:
+                await _send_response(writer, 431)
+                metrics.count(0, True, len(request_line))
+                return False
+
+            length = headers.get("content-length")
+            if length is not None and not length.isdigit():
+                # where the body ends is unknown, so the connection is closed
+                await _send_response(writer, 400)
+                metrics.count(0, True, len(request_line) + headers._size)
+                return False
+
+            method, location, query, http10 = _parse_request_line(request_line)
+            conn = Connection(reader, writer, headers)
+        except Exception:
+            # the request is invalid, counted as unmatched (_serve responds)
+            metrics.time(0, 0, started, utime.ticks_us())
+            metrics.count(
+                0, True, len(request_line) + (headers._size if headers else 0)
+            )
+            raise
+
+        if keep_alive:
+            connection = headers.get("connection", "").lower()
+            if http10:
+                keep_alive = "keep-alive" in connection
+            else:
+                keep_alive = "close" not in connection
 
         get_head = False
         if method == "HEAD":
             method = "GET"
             get_head = True
 
-        if method in self._callbacks:
-            for location_re in self._callbacks[method]:
-                if ure.search(location_re, location) is not None:
-                    resp = self._callbacks[method][location_re](
-                        method, location, params, headers, conn, addr
-                    )
-                    if get_head:
-                        resp["body"] = ""
-                    if resp is not None:
-                        send_response(conn, **resp)
-                    return
-            raise NoCallbackError
+        if headers.get("expect") == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
 
-        else:
-            raise NoMethodError
+        slot = 0
+        error = False
+        handled = utime.ticks_us()
 
-    async def catch_requests(self):
-        while True:
+        try:
+            callback, request, slot = self._resolve(method, location)
+            req = Request(method, location, query, headers, conn, addr)
+
+            # synchronous callbacks get the socket in blocking mode
+            conn.settimeout(self._timeout)
             try:
-                conn, addr = self._sock.accept()
+                if request:
+                    resp = callback(req)
+                else:
+                    resp = callback(
+                        method, location, req.params, headers, conn, addr
+                    )
+            finally:
+                conn.setblocking(False)
 
-            except OSError:
-                # no incoming connections
-                await uasyncio.sleep(0)
+            if hasattr(resp, "send"):
+                # coroutine callback
+                resp = await resp
 
-            else:
-                conn.settimeout(self._timeout)
-                try:
-                    await self.processor(conn, addr)
-                except Exception as exc:
-                    resp = error_view(exc)
-                    if resp is not None:
-                        send_response(conn, **resp)
+        except Exception as exc:
+            get_head = False
+            error = True
+            resp = error_view(exc)
+            if resp is None:
+                resp = response(500)
+
+        try:
+            # skip what's left of the request body, so the next request can be read, or
+            # the connection can be closed cleanly
+            await conn._skip()
+
+            sending = utime.ticks_us()
+            metrics.time(slot, 1, handled, sending)
+            bytes_in = len(request_line) + headers._size + conn._received
+            sent = 0
+
+            if resp is None:
+                keep_alive = False  # response was sent by the callback
+            elif isinstance(resp, dict):
+                resp = Response(**resp)
+
+            try:
+                if resp is not None:
+                    if isinstance(resp, PreparedResponse):
+                        keep_alive, sent = await resp._send(
+                            writer, keep_alive, get_head
+                        )
                     else:
-                        send_response(conn, 500)
-                conn.close()
+                        keep_alive, sent = await _send_response(
+                            writer,
+                            resp.status,
+                            resp.body,
+                            resp.content_type,
+                            resp.headers,
+                            head_only=get_head,
+                            keep_alive=keep_alive,
+                            chunked=not http10,
+                        )
+            except Exception:
+                # the response is already partly sent, so the connection is closed,
+                # which the client can tell apart from a complete response
+                keep_alive = False
+                error = True
+
+        finally:
+            if conn._stream:
+                # counted as a connection again, until it's closed (see open_stream)
+                self._streams -= 1
+                self._connections += 1
+
+        metrics.time(slot, 0, started, handled)  # the route is known only now
+        metrics.time(slot, 2, sending, utime.ticks_us())
+        metrics.count(slot, error, bytes_in, sent)
+        return keep_alive
+
+    async def _serve(self, reader, writer):
+        # runs as a separate task for every connection
+        if self._overloaded():
+            try:
+                # an unread request would make closing reset the connection, and the
+                # client would likely miss the response
+                await uasyncio.wait_for(self._discard_head(reader), self._timeout)
+            except Exception:
+                pass
+            try:
+                writer.write(_unavailable_response)
+                await writer.drain()
+            except Exception:
+                pass
+            writer.close()
+            await writer.wait_closed()
+            return
+
+        self._connections += 1
+        addr = writer.get_extra_info("peername")
+        kept_alive = False
+        try:
+            requests = 0
+            while True:
+                requests += 1
+                keep_alive = (
+                    self._keep_alive_timeout > 0
+                    and requests < self._keep_alive_requests  # noqa
+                    and (  # noqa
+                        kept_alive
+                        or self._kept_alive < self._keep_alive_connections  # noqa
+                    )
+                )
+                if keep_alive and not kept_alive:
+                    # count the connection as kept alive right away, to respect the
+                    # limit when connections are processed concurrently
+                    kept_alive = True
+                    self._kept_alive += 1
+
+                try:
+                    keep_alive = await self.processor(
+                        reader,
+                        writer,
+                        addr,
+                        keep_alive,
+                        self._keep_alive_timeout if requests > 1 else None,
+                    )
+                except uasyncio.TimeoutError:
+                    if requests > 1:
+                        break  # kept-alive connection idle
+                    raise
+
+                if not keep_alive:
+                    break
+
+        except Exception as exc:
+            # the request could not be parsed, so the connection will be reset
+            try:
+                resp = error_view(exc)
+                if resp is not None:
+                    await _send_response(writer, **resp)
+                else:
+                    await _send_response(writer, 500)
+            except Exception:
+                pass  # connection lost, nobody to respond to
+
+        finally:
+            self._connections -= 1
+            if kept_alive:
+                self._kept_alive -= 1
+            writer.close()
+            await writer.wait_closed()
+
+    async def catch_requests(self):
+        self._server = await uasyncio.start_server(
+            self._serve, "0.0.0.0", self._port, self._backlog
+        )
+        try:
+            await self._server.wait_closed()
+        finally:
+            self.close()
@@ -24,6 +24,7 @@ _tasks = {}
 
 _error_name = ""
 _traceback = ""
+_code_file = None  # "code.py" or "code.mpy", whichever is imported
 
 
 ERROR = 0
@@ -34,12 +35,26 @@ CODE_MAIN = 4
 
 
 _state = STOPPED
+_state_event = None  # set whenever the state changes, see notify_state
 
 
 def get_state():
     return _state
 
 
+def notify_state(event):
+    # set event (an Event) whenever the state changes
+    global _state_event
+    _state_event = event
+
+
+def _set_state(state):
+    global _state
+    _state = state
+    if _state_event is not None:
+        _state_event.set()
+
+
 def get_error():
     return (_error_name, _traceback) if _state == ERROR else None
 
@@ -48,25 +63,63 @@ def get_tasks():
     return _tasks
 
 
-def start():
-    global _state
+def get_code_file():
+    return _code_file
 
-    if _state <= STOPPED:
-        try:
-            uos.stat("/code.py")
 
+def _find_code():
+    # MicroPython imports code.py if it exists, and code.mpy only if it does not
+    for file_name in ("code.py", "code.mpy"):
+        try:
+            uos.stat("/" + file_name)
         except Exception:
-            _state = CODE_MISSING
+            continue
+        return file_name
+    return None
+
+
+def _check_mpy(file_name):
+    # Check the header of an .mpy file against the .mpy version of the firmware, so an
+    # incompatible file fails with a clear error instead of an obscure one on import.
+    if not hasattr(sys.implementation, "mpy"):
+        return  # the firmware does not tell
+    mpy = sys.implementation.mpy
+    with open("/" + file_name, "rb") as file:
+        header = file.read(3)
+    if (
+        len(header) < 3
+        or header[0] != ord("M")
+        or header[1] != mpy & 0xFF
+        or header[2] & 3 != (mpy >> 8) & 3
+    ):
+        raise ImportError(
+            "{} incompatible with firmware (needs .mpy version {})".format(
+                file_name, mpy & 0xFF
+            )
+        )
+
+
+def start():
+    global _code_file
+
+    if _state <= STOPPED:
+        _code_file = None  # set once imported
+        file_name = _find_code()
+        if file_name is None:
+            _set_state(CODE_MISSING)
             return
 
         try:
+            if file_name.endswith(".mpy"):
+                _check_mpy(file_name)
             import code
 
-            _state = CODE_IMPORTED
+            _code_file = file_name
+            _set_state(CODE_IMPORTED)
             if hasattr(code, "main"):
                 if callable(code.main):
                     code.main()
-                    _state = CODE_MAIN
+                    _set_state(CODE_MAIN)
 
         except ImportError as exc:
             _handle_error(exc, cleanup=False)
@@ -80,12 +133,10 @@ async def starter_coro():
 
 
 def stop(force=False, exc=None):
-    global _state
-
     if _state > STOPPED or force:
         for task_name in _tasks:
             destroy_task(task_name)
-        _state = STOPPED
+        _set_state(STOPPED)
 
         if not force:
             try:
@@ -143,15 +194,15 @@ async def _task_wrapper_coro(coro, *args):
 
 
 def _handle_error(exc, cleanup):
-    global _state, _error_name, _traceback
+    global _error_name, _traceback
 
     stop(force=True)
-    _state = ERROR
     _error_name = exc.__class__.__name__
 
     exc_details = uio.StringIO()
     sys.print_exception(exc, exc_details)
     _traceback = exc_details.getvalue()
+    _set_state(ERROR)
 
     if cleanup:
         try:
@@ -0,0 +1,84 @@
+# Kyanit (Core) - tests/parse_bench.py
+# Copyright (C) 2020 Zsolt Nagy
+#
+# This program is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this
+# program. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Compares request line parsing of httpsrv against the former ure-based implementation.
+# Run on the board with: import parse_bench
+
+import gc
+
+import ure
+import utime
+from kyanit import httpsrv
+
+ITERATIONS = 200
+
+REQUEST_LINES = [
+    b"GET /sys/state HTTP/1.1\r\n",
+    b"GET /files/code.py HTTP/1.1\r\n",
+    b"PUT /files/old%20name.py?rename=new%20name.py HTTP/1.1\r\n",
+    b"GET /sensors/data?from=10&to=20&unit=C&avg&fmt=json HTTP/1.1\r\n",
+]
+
+
+def former_parse(request_line):
+    request_line = request_line.decode()
+    match = ure.search(
+        "([A-Z]+) ((\/[{0}]*)+)\??([{0}|\=|\&]+)? HTTP".format(  # noqa
+            "a-z|A-Z|0-9|\.|\%|\-|\_|\~"  # noqa
+        ),
+        request_line,
+    )
+    method = match.group(1)
+    location = httpsrv.unencode(match.group(2))
+    params_str = match.group(4)
+    if params_str:
+        params = {
+            httpsrv.unencode(key): httpsrv.unencode(value)
+            for (key, value) in [
+                (param.split("=")[0], param.split("=")[1])
+                if "=" in param
+                else (param, None)
+                for param in params_str.split("&")
+            ]
+        }
+    else:
+        params = {}
+    return method, location, params
+
+
+def current_parse(request_line):
+    method, location, query, _ = httpsrv._parse_request_line(request_line)
+    return method, location, httpsrv._parse_query(query) if query else {}
+
+
+def bench(parse, request_line):
+    start = utime.ticks_us()
+    for _ in range(ITERATIONS):
+        parse(request_line)
+    elapsed = utime.ticks_diff(utime.ticks_us(), start)
+    # allocation is measured over a single run, with no collection in between
+    gc.collect()
+    mem_before = gc.mem_alloc()
+    parse(request_line)
+    return elapsed // ITERATIONS, gc.mem_alloc() - mem_before
+
+
+for request_line in REQUEST_LINES:
+    assert former_parse(request_line) == current_parse(request_line), request_line
+    former_us, former_mem = bench(former_parse, request_line)
+    current_us, current_mem = bench(current_parse, request_line)
+    print(request_line.strip())
+    print("  former:  {} us, {} bytes".format(former_us, former_mem))
+    print("  current: {} us, {} bytes".format(current_us, current_mem))
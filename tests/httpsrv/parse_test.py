@@ -0,0 +1,152 @@
+# Kyanit (Core) - tests/parse_test.py
+# Copyright (C) 2020 Zsolt Nagy
+#
+# This program is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along with this
+# program. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Checks request parsing of httpsrv: query strings, route rules, request bodies and
+# byte ranges.
+# Run on the board with: import parse_test
+
+import uio
+from kyanit import httpsrv
+
+
+class FakeSocket:
+    # a socket reading from data, as wrapped by httpsrv.Connection
+
+    def __init__(self, data):
+        self._data = uio.BytesIO(data)
+        self.recv = self._data.read
+        self.readline = self._data.readline
+        self.readinto = self._data.readinto
+
+
+class FakeStream:
+    def __init__(self, data):
+        self.s = FakeSocket(data)
+
+
+def read_body(data, headers):
+    conn = httpsrv.Connection(None, FakeStream(data), headers)
+    body = httpsrv.readall_from(conn).getvalue()
+    return body, conn.received_all()
+
+
+def check(name, result, expected):
+    assert result == expected, "{}: {!r} != {!r}".format(name, result, expected)
+    print("OK", name)
+
+
+# query strings
+
+check("query empty", httpsrv._parse_query(b""), {})
+check("query plain", httpsrv._parse_query(b"a=1&b=2"), {"a": "1", "b": "2"})
+check("query no value", httpsrv._parse_query(b"a&b="), {"a": None, "b": ""})
+check("query repeated", httpsrv._parse_query(b"a=1&a=2&a"), {"a": ["1", "2", None]})
+check("query empty params", httpsrv._parse_query(b"&a=1&&"), {"a": "1"})
+check("query encoded", httpsrv._parse_query(b"a%20b=c%26d"), {"a b": "c&d"})
+check("query not utf-8", httpsrv._parse_query(b"a=%FF"), {"a": "%FF"})
+
+# route rules
+
+check("rule literal", httpsrv._split_rule("^/sys/state$"), ("/sys/state", "$"))
+check("rule prefix", httpsrv._split_rule("^/files/.*"), ("/files/", ".*"))
+check("rule unanchored", httpsrv._split_rule("/files"), ("", "/files"))
+check("rule star", httpsrv._split_rule("^/files*$"), ("/file", "s*$"))
+check("rule plus", httpsrv._split_rule("^/ab+"), ("/a", "b+"))
+check("rule optional", httpsrv._split_rule("^/ab?$"), ("/a", "b?$"))
+check("rule repeat", httpsrv._split_rule("^/ab{2}$"), ("/a", "b{2}$"))
+check("rule alternation", httpsrv._split_rule("^/a|/b"), ("/a", "|/b"))
+
+srv = httpsrv.HTTPServer(80)
+for rule in ("^/files*$", "^/ab+$", "^/x|/y", "^/sys/state$", "^/files/.*"):
+    srv.register("GET", rule, lambda *args: None)
+routes = srv.get_registered()["GET"]
+for location, rule in (
+    ("/file", "^/files*$"),
+    ("/filesss", "^/files*$"),
+    ("/abbb", "^/ab+$"),
+    ("/y", "^/x|/y"),
+    ("/sys/state", "^/sys/state$"),
+    ("/files/code.py", "^/files/.*"),
+):
+    check("resolve " + location, srv._resolve("GET", location)[0], routes[rule])
+try:
+    srv._resolve("GET", "/a")
+    raise AssertionError("resolve /a: no error")
+except httpsrv.NoCallbackError:
+    print("OK resolve /a")
+
+# request bodies
+
+length = {"content-length": "5"}
+check("body length", read_body(b"hello world", length), (b"hello", True))
+check("body none", read_body(b"hello", {}), (b"", True))
+check("body short", read_body(b"hel", length), (b"hel", False))
+chunked = {"transfer-encoding": "chunked"}
+check(
+    "body chunked",
+    read_body(b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n", chunked),
+    (b"hello world", True),
+)
+check(
+    "body chunk extensions",
+    read_body(
+        b"5;name=value\r\nhello\r\nA ; x\r\n0123456789\r\n0;end\r\n\r\n", chunked
+    ),
+    (b"hello0123456789", True),
+)
+check(
+    "body trailers",
+    read_body(b"5\r\nhello\r\n0\r\nX-Sum: 1\r\nX-Other: 2\r\n\r\nGET /", chunked),
+    (b"hello", True),
+)
+check(
+    "body chunked upper case",
+    read_body(b"5\r\nhello\r\n0\r\n\r\n", {"transfer-encoding": "Chunked"}),
+    (b"hello", True),
+)
+check("body closed in chunk", read_body(b"5\r\nhel", chunked), (b"hel", False))
+check(
+    "body closed after chunk", read_body(b"5\r\nhello\r\n", chunked), (b"hello", False)
+)
+check("body closed at start", read_body(b"", chunked), (b"", False))
+
+# byte ranges (of a 100 byte resource, with entity tag "e")
+
+
+def byte_range(value, if_range=None):
+    headers = {"range": value}
+    if if_range is not None:
+        headers["if-range"] = if_range
+    return httpsrv.byte_range(headers, 100, '"e"')
+
+
+check("range none", httpsrv.byte_range({}, 100), None)
+check("range closed", byte_range("bytes=10-19"), (10, 20))
+check("range open", byte_range("bytes=90-"), (90, 100))
+check("range suffix", byte_range("bytes=-10"), (90, 100))
+check("range suffix over size", byte_range("bytes=-200"), (0, 100))
+check("range stop over size", byte_range("bytes=50-200"), (50, 100))
+check("range start at size", byte_range("bytes=100-"), (100, 100))
+check("range start over size", byte_range("bytes=150-160"), (100, 100))
+check("range reversed", byte_range("bytes=20-10"), None)
+check("range invalid", byte_range("bytes=a-b"), None)
+check("range signed", byte_range("bytes=--5"), None)
+check("range plus sign", byte_range("bytes=+5-"), None)
+check("range signed suffix", byte_range("bytes=-+5"), None)
+check("range no bounds", byte_range("bytes=-"), None)
+check("range other unit", byte_range("items=0-1"), None)
+check("range multiple", byte_range("bytes=0-1,5-6"), None)
+check("range if-range match", byte_range("bytes=0-9", '"e"'), (0, 10))
+check("range if-range changed", byte_range("bytes=0-9", '"f"'), None)